@@ -28,9 +28,11 @@ __plugin_meta__ = PluginMetadata(
         superuser_help="""
         超级管理员额外命令
         格式:
-            查看会话 ?user : 查看指定user的会话记录或全部会话列表
-            清理会话 @user / uid : 用于清理指定用户的会话记录,支持多个目标
+            查看会话 ?user ?记录id : 查看指定user早于该id的会话记录或全部会话列表
+            清理会话 @user / uid : 用于清理指定用户的会话记录,支持多个目标,
+                以*结尾时按前缀清理(如 g-* 清理全部群聊会话)
             清理全部会话: 清理Bot缓存的全部会话记录
+            查看AI状态: 查看线程池、缓存等运行状态
             启用/禁用伪人模式 群号: 开启或关闭指定群聊的伪人模式，空格是可选的
         """,
         configs=[
@@ -57,6 +59,42 @@ __plugin_meta__ = PluginMetadata(
                 "，启用后忽略图像理解模型配置项",
                 default_value=False,
             ),
+            RegisterConfig(
+                key="IMAGE_URL_PASSTHROUGH",
+                value=False,
+                type=bool,
+                help="多模态模式下直接将图片链接发送给模型，不在本地下载与保存图片；"
+                "链接会过期，因此图片只在当轮对话中发送",
+                default_value=False,
+            ),
+            RegisterConfig(
+                key="IMAGE_MAX_MB",
+                value=10,
+                type=int,
+                help="多模态模式下允许下载的图片大小上限(MB)，超出时改用图片描述",
+                default_value=10,
+            ),
+            RegisterConfig(
+                key="IMAGE_MAX_EDGE",
+                value=1568,
+                type=int,
+                help="多模态模式下图片最长边超过该像素时缩放后再保存, 0表示不缩放",
+                default_value=1568,
+            ),
+            RegisterConfig(
+                key="IMAGE_QUALITY",
+                value=85,
+                type=int,
+                help="缩放图片时重新编码的JPEG质量(1-95)",
+                default_value=85,
+            ),
+            RegisterConfig(
+                key="IMAGE_FETCH_CONCURRENCY",
+                value=4,
+                type=int,
+                help="同时下载的图片数量上限",
+                default_value=4,
+            ),
             RegisterConfig(
                 key="PIC_MODEL",
                 value="cogview-3-flash",
@@ -78,6 +116,29 @@ __plugin_meta__ = PluginMetadata(
                 help="所使用的图像理解模型",
                 default_value="glm-4.6v-flash",
             ),
+            RegisterConfig(
+                key="IMAGE_DESC_CACHE_SIZE",
+                value=5000,
+                type=int,
+                help="持久化保存的图片描述数量上限，超出时淘汰最久未使用的描述, "
+                "0表示不限制",
+                default_value=5000,
+            ),
+            RegisterConfig(
+                key="IMAGE_DESC_CONCURRENCY",
+                value=4,
+                type=int,
+                help="单条消息中同时生成描述的图片数量上限",
+                default_value=4,
+            ),
+            RegisterConfig(
+                key="IMAGE_DESC_TIMEOUT",
+                value=15,
+                type=int,
+                help="单条消息等待图片描述的最长时间(秒)，超时的图片以占位文本代替, "
+                "0表示不限制",
+                default_value=15,
+            ),
             RegisterConfig(
                 key="CHAT_MODE",
                 value="user",
@@ -113,6 +174,36 @@ __plugin_meta__ = PluginMetadata(
                 help="禁用伪人模式的群组列表",
                 default_value=[],
             ),
+            RegisterConfig(
+                key="IMPERSONATION_DEBOUNCE",
+                value=1.5,
+                type=float,
+                help="伪人模式触发后等待的秒数，期间的连续消息合并为一次回复",
+                default_value=1.5,
+            ),
+            RegisterConfig(
+                key="IMPERSONATION_STALE_MESSAGES",
+                value=3,
+                type=int,
+                help="伪人回复生成期间群内新增超过该条数的消息时丢弃该回复, "
+                "0表示不丢弃",
+                default_value=3,
+            ),
+            RegisterConfig(
+                key="IMPERSONATION_BUFFER_GROUPS",
+                value=500,
+                type=int,
+                help="伪人模式在内存中缓存最近消息的群数量上限，"
+                "超出时淘汰最久没有消息的群",
+                default_value=500,
+            ),
+            RegisterConfig(
+                key="ROSTER_TTL",
+                value=1800,
+                type=int,
+                help="群成员名片缓存的刷新间隔(秒)，过期后在后台重新获取成员列表",
+                default_value=1800,
+            ),
             RegisterConfig(
                 key="EXPIRE_DAY",
                 value=3,
@@ -120,6 +211,20 @@ __plugin_meta__ = PluginMetadata(
                 help="用户对话记录保存时间(天), -1表示永久保存",
                 default_value=3,
             ),
+            RegisterConfig(
+                key="EXPIRE_BATCH_SIZE",
+                value=500,
+                type=int,
+                help="清理过期对话记录时每个事务最多删除的记录数",
+                default_value=500,
+            ),
+            RegisterConfig(
+                key="EXPIRE_MAX_BATCHES",
+                value=20,
+                type=int,
+                help="每次清理任务(每10分钟)最多执行的批次数，剩余记录留到下次清理",
+                default_value=20,
+            ),
             RegisterConfig(
                 key="WORD_LIMIT",
                 value=1000,
@@ -134,6 +239,208 @@ __plugin_meta__ = PluginMetadata(
                 help="单次对话消息最大分割段数, 0表示无限分割, -1表示不分割",
                 default_value=3,
             ),
+            RegisterConfig(
+                key="STREAM_MODE",
+                value=False,
+                type=bool,
+                help="是否启用流式回复，边生成边按段发送",
+                default_value=False,
+            ),
+            RegisterConfig(
+                key="HTTP_POOL_SIZE",
+                value=20,
+                type=int,
+                help="与智谱API之间的最大连接数",
+                default_value=20,
+            ),
+            RegisterConfig(
+                key="HTTP_KEEPALIVE",
+                value=10,
+                type=int,
+                help="连接池中保持存活的最大空闲连接数",
+                default_value=10,
+            ),
+            RegisterConfig(
+                key="CONTEXT_TOKEN_BUDGET",
+                value=16000,
+                type=int,
+                help="每次对话发送的上下文token上限(估算), 0表示不限制",
+                default_value=16000,
+            ),
+            RegisterConfig(
+                key="CONTEXT_FULL_TURNS",
+                value=3,
+                type=int,
+                help="只有最近几轮对话保留图片与完整的工具调用，更早的替换为简短说明, "
+                "0表示全部保留",
+                default_value=3,
+            ),
+            RegisterConfig(
+                key="MODEL_TOKEN_BUDGETS",
+                value={},
+                type=dict[str, int],
+                help="单独设置某些模型的上下文token上限, 格式为 {模型: token数}",
+                default_value={},
+            ),
+            RegisterConfig(
+                key="HISTORY_FLUSH_INTERVAL",
+                value=1,
+                type=float,
+                help="对话记录批量写入数据库的间隔(秒), 0表示每轮对话结束时立即写入",
+                default_value=1,
+            ),
+            RegisterConfig(
+                key="HISTORY_QUEUE_SIZE",
+                value=1000,
+                type=int,
+                help="等待写入数据库的对话记录上限，超出时新的对话会等待写入完成",
+                default_value=1000,
+            ),
+            RegisterConfig(
+                key="HISTORY_CACHE_MAX_ENTRIES",
+                value=1000,
+                type=int,
+                help="内存中最多缓存多少个会话的历史记录，超出时淘汰最久未使用的会话, "
+                "0表示不限制",
+                default_value=1000,
+            ),
+            RegisterConfig(
+                key="HISTORY_CACHE_MAX_MB",
+                value=64,
+                type=int,
+                help="历史记录缓存占用内存的估算上限(MB)，超出时淘汰最久未使用的会话, "
+                "0表示不限制",
+                default_value=64,
+            ),
+            RegisterConfig(
+                key="COMPACT_THRESHOLD",
+                value=120,
+                type=int,
+                help="单个会话未压缩的记录超过该条数时，在后台将较早的对话压缩为摘要, "
+                "0表示不压缩",
+                default_value=120,
+            ),
+            RegisterConfig(
+                key="COMPACT_KEEP",
+                value=40,
+                type=int,
+                help="压缩时保留不压缩的最近记录条数",
+                default_value=40,
+            ),
+            RegisterConfig(
+                key="SUMMARY_MODEL",
+                value="glm-4-flash",
+                type=str,
+                help="压缩对话历史所使用的模型，建议使用免费模型",
+                default_value="glm-4-flash",
+            ),
+            RegisterConfig(
+                key="ROUTER_LIGHT_MODELS",
+                value=[],
+                type=list[str],
+                help="用于简单闲聊的轻量对话模型，留空则所有对话都使用CHAT_MODEL",
+                default_value=[],
+            ),
+            RegisterConfig(
+                key="ROUTER_LIGHT_MAX_LEN",
+                value=30,
+                type=int,
+                help="不含图片/引用/工具意图且不超过该字数的消息视为简单闲聊",
+                default_value=30,
+            ),
+            RegisterConfig(
+                key="REQUEST_TIMEOUT",
+                value=60,
+                type=int,
+                help="单次对话请求的超时时间(秒), 0表示使用客户端默认的超时时间",
+                default_value=60,
+            ),
+            RegisterConfig(
+                key="RETRY_TIMES",
+                value=2,
+                type=int,
+                help="对话请求遇到超时/服务端错误时的重试次数",
+                default_value=2,
+            ),
+            RegisterConfig(
+                key="FALLBACK_MODELS",
+                value=[],
+                type=list[str],
+                help="主模型不可用时依次尝试的备用对话模型",
+                default_value=[],
+            ),
+            RegisterConfig(
+                key="BREAKER_THRESHOLD",
+                value=5,
+                type=int,
+                help="模型连续失败多少次后熔断",
+                default_value=5,
+            ),
+            RegisterConfig(
+                key="BREAKER_COOLDOWN",
+                value=60,
+                type=int,
+                help="模型熔断后的冷却时间(秒)，冷却期内直接使用备用模型",
+                default_value=60,
+            ),
+            RegisterConfig(
+                key="RATE_LIMIT_RPM",
+                value=0,
+                type=int,
+                help="每个模型每分钟最多请求次数, "
+                "0表示不限制(仅在收到限流响应后退避)",
+                default_value=0,
+            ),
+            RegisterConfig(
+                key="RATE_LIMIT_TPM",
+                value=0,
+                type=int,
+                help="每个模型每分钟最多消耗的token数(估算), 0表示不限制",
+                default_value=0,
+            ),
+            RegisterConfig(
+                key="RATE_LIMIT_MODELS",
+                value={},
+                type=dict[str, list[int]],
+                help="单独设置某些模型的限流, "
+                "格式为 {模型: [每分钟请求数, 每分钟token数]}",
+                default_value={},
+            ),
+            RegisterConfig(
+                key="CHAT_WORKERS",
+                value=8,
+                type=int,
+                help="对话请求线程池大小",
+                default_value=8,
+            ),
+            RegisterConfig(
+                key="VISION_WORKERS",
+                value=4,
+                type=int,
+                help="图像理解请求线程池大小",
+                default_value=4,
+            ),
+            RegisterConfig(
+                key="MEDIA_WORKERS",
+                value=2,
+                type=int,
+                help="图片/视频生成请求线程池大小",
+                default_value=2,
+            ),
+            RegisterConfig(
+                key="POLL_WORKERS",
+                value=2,
+                type=int,
+                help="后台任务(视频状态轮询、历史压缩)线程池大小",
+                default_value=2,
+            ),
+            RegisterConfig(
+                key="IMAGE_WORKERS",
+                value=2,
+                type=int,
+                help="图片解码与缩放线程池大小",
+                default_value=2,
+            ),
         ],
     ).dict(),
 )
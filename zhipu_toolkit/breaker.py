@@ -0,0 +1,97 @@
+import time
+from typing import Any, ClassVar
+
+import httpx
+
+from .config import ChatConfig
+
+
+def is_transient(e: Exception) -> bool:
+    """判断异常是否为可重试的临时性错误（超时、连接失败、服务端 5xx）"""
+    if isinstance(e, httpx.TransportError | TimeoutError | ConnectionError):
+        return True
+    status = getattr(e, "status_code", None)
+    if status is None and (response := getattr(e, "response", None)) is not None:
+        status = getattr(response, "status_code", None)
+    if isinstance(status, int):
+        return status >= 500
+    error = str(e).lower()
+    return "timeout" in error or "timed out" in error or "connection" in error
+
+
+class CircuitBreaker:
+    """单个模型的熔断器
+
+    连续失败达到阈值后熔断，冷却期内直接拒绝请求；冷却结束后放行一次探测请求，
+    成功则恢复，失败则重新熔断。
+    """
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+
+    @property
+    def threshold(self) -> int:
+        return max(int(ChatConfig.get("BREAKER_THRESHOLD") or 5), 1)
+
+    @property
+    def cooldown(self) -> float:
+        return float(ChatConfig.get("BREAKER_COOLDOWN") or 60)
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        match self.state:
+            case "closed":
+                return True
+            case "half_open" if not self.probing:
+                self.probing = True
+                return True
+            case _:
+                return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self) -> None:
+        """请求因非健康原因结束（如内容审查）时释放探测名额"""
+        self.probing = False
+
+    def stats(self) -> dict[str, Any]:
+        return {"state": self.state, "failures": self.failures}
+
+
+class Breakers:
+    breakers: ClassVar[dict[str, CircuitBreaker]] = {}
+
+    @classmethod
+    def get(cls, model: str) -> CircuitBreaker:
+        if (breaker := cls.breakers.get(model)) is None:
+            breaker = cls.breakers[model] = CircuitBreaker(model)
+        return breaker
+
+    @classmethod
+    def report(cls) -> list[str]:
+        lines = ["[熔断器]"]
+        lines.extend(
+            f"{model}: {s['state']}, 连续失败 {s['failures']}"
+            for model, breaker in cls.breakers.items()
+            if (s := breaker.stats())
+        )
+        return lines
@@ -0,0 +1,140 @@
+from collections import OrderedDict, deque
+import datetime
+import time
+
+from nonebot_plugin_apscheduler import scheduler
+
+from zhenxun.models.chat_history import ChatHistory
+from zhenxun.services.log import logger
+
+from .config import ChatConfig
+
+# 伪人模式读取的最近消息条数
+CONTEXT_SIZE = 20
+# 单条消息最多保留的字数
+MAX_TEXT_LEN = 500
+# 超过该时长没有新消息的群会被移出缓冲
+IDLE_SECONDS = 60 * 60
+
+
+def _naive(value: datetime.datetime) -> datetime.datetime:
+    """统一为本地时区的 naive datetime，与监听器记录的时间一致"""
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+class GroupRecord:
+    __slots__ = ("bot_id", "create_time", "text", "user_id")
+
+    def __init__(
+        self, bot_id: str, user_id: str, create_time: datetime.datetime, text: str
+    ) -> None:
+        self.bot_id = bot_id
+        self.user_id = user_id
+        self.create_time = create_time
+        self.text = text[:MAX_TEXT_LEN]
+
+
+class _Group:
+    __slots__ = ("last_active", "records", "seeded", "version")
+
+    def __init__(self) -> None:
+        self.records: deque[GroupRecord] = deque(maxlen=CONTEXT_SIZE)
+        self.seeded = False
+        self.last_active = time.monotonic()
+        self.version = 0
+        """收到的消息数，用于判断读取之后是否有新消息"""
+
+
+class GroupBuffer:
+    """按群保存最近消息的环形缓冲
+
+    由低优先级的消息监听器写入，伪人模式直接读取而无需查询数据库；某个群首次读取时
+    从数据库补充一次更早的记录。缓冲的群数量受 `IMPERSONATION_BUFFER_GROUPS` 限制，
+    长时间没有消息的群会被移出。
+    """
+
+    def __init__(self) -> None:
+        self._groups: OrderedDict[str, _Group] = OrderedDict()
+
+    @property
+    def max_groups(self) -> int:
+        return max(int(ChatConfig.get("IMPERSONATION_BUFFER_GROUPS") or 500), 1)
+
+    def _touch(self, group_id: str) -> _Group:
+        if (group := self._groups.get(group_id)) is None:
+            group = self._groups[group_id] = _Group()
+            while len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(group_id)
+        group.last_active = time.monotonic()
+        return group
+
+    def append(self, group_id: str, bot_id: str, user_id: str, text: str) -> None:
+        if not text.strip():
+            return
+        group = self._touch(group_id)
+        now = datetime.datetime.now()
+        group.records.append(GroupRecord(bot_id, user_id, now, text))
+        group.version += 1
+
+    def version(self, group_id: str) -> int:
+        group = self._groups.get(group_id)
+        return group.version if group is not None else 0
+
+    async def recent(self, group_id: str) -> list[GroupRecord]:
+        """获取群内最近的消息，按时间倒序排列"""
+        group = self._touch(group_id)
+        if not group.seeded:
+            if limit := CONTEXT_SIZE - len(group.records):
+                await self._seed(group_id, group, limit)
+            group.seeded = True
+        return list(reversed(group.records))
+
+    @staticmethod
+    async def _seed(group_id: str, group: _Group, limit: int) -> None:
+        """用数据库中的记录补齐缓冲
+
+        消息记录由 chat_history 插件定时批量写入，数据库中可能还没有最近的消息，因此
+        保留监听器已缓冲的记录，只在其前面补充更早的记录。
+        """
+        query = ChatHistory.filter(group_id=group_id).exclude(text="")
+        if group.records:
+            query = query.filter(create_time__lt=group.records[0].create_time)
+        rows = (
+            await query.order_by("-create_time")
+            .limit(limit)
+            .values_list("bot_id", "user_id", "create_time", "text")
+        )
+        older = [
+            GroupRecord(bot_id, user_id, _naive(create_time), text)
+            for bot_id, user_id, create_time, text in reversed(rows)
+        ]
+        # 查询期间可能有新消息写入缓冲，合并后只保留最近的部分
+        records = [*older, *group.records][-CONTEXT_SIZE:]
+        group.records.clear()
+        group.records.extend(records)
+
+    def prune(self) -> int:
+        """移出长时间没有消息的群，返回移出的数量"""
+        now = time.monotonic()
+        count = 0
+        while self._groups:
+            group_id, group = next(iter(self._groups.items()))
+            if now - group.last_active <= IDLE_SECONDS:
+                break
+            del self._groups[group_id]
+            count += 1
+        return count
+
+
+GROUP_BUFFER = GroupBuffer()
+
+
+@scheduler.scheduled_job("interval", minutes=10, id="zhipu_prune_group_buffer")
+async def _prune_group_buffer() -> None:
+    """定时任务：清理长时间没有消息的群聊缓冲"""
+    if count := GROUP_BUFFER.prune():
+        logger.debug(f"移出 {count} 个不活跃群的消息缓冲", "zhipu_toolkit")
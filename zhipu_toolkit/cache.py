@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from collections.abc import Callable
+import time
+from typing import Any
+
+from .config import ChatConfig
+
+
+def message_size(message: dict) -> int:
+    """估算一条缓存消息占用的字节数（以字符数近似，含多模态图片数据）"""
+    content = message.get("content")
+    if isinstance(content, list):
+        size = sum(
+            len(part.get("text") or "")
+            if part.get("type") == "text"
+            else len(part.get("image_url", {}).get("url") or "")
+            for part in content
+        )
+    else:
+        size = len(content or "")
+    if tool_calls := message.get("tool_calls"):
+        size += len(str(tool_calls))
+    return size + 64
+
+
+class HistoryEntry:
+    __slots__ = ("data", "last_access", "size", "tokens")
+
+    def __init__(self, data: list[dict], tokens: list[int]) -> None:
+        self.data = data
+        """与 get_history 返回格式一致的历史记录"""
+        self.tokens = tokens
+        """与 data 一一对应的 token 估算值"""
+        self.size = sum(message_size(m) for m in data)
+        self.last_access = time.monotonic()
+
+
+class HistoryCache:
+    """对话历史的 LRU 缓存
+
+    条目按最近访问顺序排列：命中时移到队尾，过期与淘汰都从队首开始，均为 O(1)。
+    除单条 TTL 外，还限制全局条目数与估算字节数。
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._entries: OrderedDict[str, HistoryEntry] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def max_entries(self) -> int:
+        return int(ChatConfig.get("HISTORY_CACHE_MAX_ENTRIES") or 0)
+
+    @property
+    def max_bytes(self) -> int:
+        return int(float(ChatConfig.get("HISTORY_CACHE_MAX_MB") or 0) * 1024 * 1024)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._entries
+
+    def _remove(self, uid: str) -> HistoryEntry | None:
+        entry = self._entries.pop(uid, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        return entry
+
+    def _expired(self, entry: HistoryEntry, now: float) -> bool:
+        return now - entry.last_access > self.ttl
+
+    def get(self, uid: str) -> HistoryEntry | None:
+        """获取未过期的条目并刷新其访问时间"""
+        entry = self._entries.get(uid)
+        now = time.monotonic()
+        if entry is not None and self._expired(entry, now):
+            self._remove(uid)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry.last_access = now
+        self._entries.move_to_end(uid)
+        return entry
+
+    def peek(self, uid: str) -> HistoryEntry | None:
+        """获取条目但不影响命中统计与访问顺序"""
+        return self._entries.get(uid)
+
+    def put(self, uid: str, data: list[dict], tokens: list[int]) -> HistoryEntry:
+        self._remove(uid)
+        entry = self._entries[uid] = HistoryEntry(data, tokens)
+        self.bytes += entry.size
+        self._evict()
+        return entry
+
+    def refresh(self, uid: str) -> None:
+        """条目内容被修改后重新计算大小并刷新访问时间"""
+        if (entry := self._entries.get(uid)) is None:
+            return
+        size = sum(message_size(m) for m in entry.data)
+        self.bytes += size - entry.size
+        entry.size = size
+        entry.last_access = time.monotonic()
+        self._entries.move_to_end(uid)
+        self._evict()
+
+    def pop(self, uid: str) -> None:
+        self._remove(uid)
+
+    def invalidate(self, match: Callable[[str], bool]) -> int:
+        """一次遍历移除所有 uid 满足 match 的条目，返回移除的数量"""
+        uids = [uid for uid in self._entries if match(uid)]
+        for uid in uids:
+            self._remove(uid)
+        return len(uids)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+
+    def _evict(self) -> None:
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        # 至少保留最近访问的一条，避免单个超大会话把自己也淘汰掉
+        while len(self._entries) > 1 and (
+            (max_entries > 0 and len(self._entries) > max_entries)
+            or (max_bytes > 0 and self.bytes > max_bytes)
+        ):
+            uid = next(iter(self._entries))
+            self._remove(uid)
+            self.evictions += 1
+
+    def prune(self) -> int:
+        """从队首清理过期条目，返回清理的数量"""
+        now = time.monotonic()
+        count = 0
+        while self._entries:
+            uid, entry = next(iter(self._entries.items()))
+            if not self._expired(entry, now):
+                break
+            self._remove(uid)
+            count += 1
+        self.expirations += count
+        return count
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def report(self) -> list[str]:
+        s = self.stats()
+        return [
+            "[历史缓存]",
+            f"{s['entries']} 个会话, 约 {s['bytes'] / 1024 / 1024:.2f}MB, "
+            f"命中 {s['hits']} / 未命中 {s['misses']} ({s['hit_rate']:.1%}), "
+            f"淘汰 {s['evictions']}, 过期 {s['expirations']}",
+        ]
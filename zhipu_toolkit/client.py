@@ -0,0 +1,81 @@
+import importlib.util
+import threading
+from typing import ClassVar
+
+import httpx
+import nonebot
+from zai import ZhipuAiClient as ZhipuAI
+
+from zhenxun.services.log import logger
+
+from .config import ChatConfig
+
+driver = nonebot.get_driver()
+
+
+class ZhipuClient:
+    """全局共享的智谱客户端
+
+    所有调用点共用同一个 `ZhipuAI` 实例及其底层连接池，复用 TLS 连接与 keep-alive，
+    仅在 `API_KEY` 发生变化时重建。
+    """
+
+    _client: ClassVar[ZhipuAI | None] = None
+    _http_client: ClassVar[httpx.Client | None] = None
+    _api_key: ClassVar[str | None] = None
+    # SDK 调用运行在线程池中，重建客户端时需要线程锁而不是 asyncio.Lock
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> ZhipuAI:
+        """获取共享客户端，API_KEY 变化时自动重建"""
+        api_key = ChatConfig.get("API_KEY")
+        client = cls._client
+        if client is not None and api_key == cls._api_key:
+            return client
+        with cls._lock:
+            if cls._client is None or api_key != cls._api_key:
+                cls._rebuild(api_key)
+            assert cls._client is not None
+            return cls._client
+
+    @classmethod
+    def _build_http_client(cls) -> httpx.Client:
+        pool_size = max(int(ChatConfig.get("HTTP_POOL_SIZE") or 20), 1)
+        keepalive = max(int(ChatConfig.get("HTTP_KEEPALIVE") or 10), 0)
+        return httpx.Client(
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=min(keepalive, pool_size),
+                keepalive_expiry=60,
+            ),
+            # 安装了 h2 时启用 HTTP/2，单连接即可多路复用
+            http2=importlib.util.find_spec("h2") is not None,
+        )
+
+    @classmethod
+    def _rebuild(cls, api_key: str | None) -> None:
+        # 旧连接池可能仍有请求在途，不主动关闭，交由垃圾回收释放
+        if cls._client is not None:
+            logger.info("API_KEY 已变更，重建智谱客户端", "zhipu_toolkit")
+        cls._http_client = cls._build_http_client()
+        # 重试由 ChatManager 统一处理，关闭 SDK 自带的重试
+        cls._client = ZhipuAI(
+            api_key=api_key, http_client=cls._http_client, max_retries=0
+        )
+        cls._api_key = api_key
+
+    @classmethod
+    def close(cls) -> None:
+        """关闭共享客户端及其连接池"""
+        with cls._lock:
+            if cls._http_client is not None:
+                cls._http_client.close()
+            cls._client = None
+            cls._http_client = None
+            cls._api_key = None
+
+
+@driver.on_shutdown
+async def _close_zhipu_client() -> None:
+    ZhipuClient.close()
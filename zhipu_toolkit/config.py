@@ -56,6 +56,15 @@ IMPERSONATION_PROMPT = """
 - 有概率玩谐音梗
 """
 
+SUMMARY_PROMPT = """
+你是对话记录整理员。请把给出的对话记录压缩成一段简洁的中文摘要，供之后的对话参考。
+要求：
+1. 保留出现过的人物（名字与Uid）、他们的偏好、关键事实、约定以及尚未结束的话题。
+2. 如果记录中包含“此前摘要”，将其内容合并进新的摘要。
+3. 忽略寒暄和重复内容，不要编造记录中没有的信息。
+4. 只输出摘要正文，不超过300字。
+"""
+
 
 class PromptCache:
     def __init__(self) -> None:
@@ -0,0 +1,122 @@
+from .config import ChatConfig
+from .images import REF_PREFIX, DescriptionCache
+from .utils import estimate_message_tokens, estimate_tokens
+
+
+def token_budget(model: str) -> int:
+    """获取模型的上下文 token 预算，<= 0 表示不限制"""
+    budgets: dict = ChatConfig.get("MODEL_TOKEN_BUDGETS") or {}
+    return int(budgets.get(model) or ChatConfig.get("CONTEXT_TOKEN_BUDGET") or 0)
+
+
+def build_context(
+    system_prompt: str,
+    history: list[dict],
+    tokens: list[int],
+    pending: list[dict],
+    budget: int,
+    full_turns: int = 0,
+) -> list[dict]:
+    """按 token 预算组装发送给模型的上下文
+
+    system prompt、历史开头的摘要记录与本轮尚未落库的记录必定保留，其余预算从最近的
+    历史开始向前填充；截断处不会以孤立的工具结果开头。较早的轮次先经 `shape_context`
+    缩小，再按缩小后的大小计入预算。
+
+    :param history: 缓存中的历史记录
+    :param tokens: 与 history 一一对应的 token 估算值
+    :param pending: 本轮的消息（用户消息、模型回复、工具结果），格式与 history 一致
+    :param full_turns: 保留图片与完整工具调用的最近轮数，见 `shape_context`
+    """
+    known = {id(m): t for m, t in zip(history, tokens)}
+    # 本轮记录以 user 消息开头，总在保留完整内容的最近轮次内
+    history = shape_context([*history, *pending], full_turns)[: -len(pending) or None]
+    # 未被改写的消息沿用缓存的估算值，只为改写过的消息重新估算
+    tokens = [known.get(id(m)) or estimate_message_tokens(m) for m in history]
+    pinned = 0
+    while pinned < len(history) and history[pinned]["role"] == "system":
+        pinned += 1
+    used = (
+        estimate_tokens(system_prompt)
+        + sum(tokens[:pinned])
+        + sum(estimate_message_tokens(m) for m in pending)
+    )
+    start = len(history)
+    while start > pinned and (budget <= 0 or used + tokens[start - 1] <= budget):
+        start -= 1
+        used += tokens[start]
+    while start < len(history) and history[start]["role"] == "tool":
+        start += 1
+    return [
+        {"role": "system", "content": system_prompt},
+        *history[:pinned],
+        *history[start:],
+        *pending,
+    ]
+
+
+def _image_stub(url: str | None) -> str:
+    description = None
+    if url and url.startswith(REF_PREFIX):
+        description = DescriptionCache.peek(url.removeprefix(REF_PREFIX))
+    return f"\n![#image:{description or '较早的图片'}]"
+
+
+def _tool_note(call: dict, results: dict[str, str]) -> str:
+    function = call.get("function") or {}
+    result = results.get(call.get("id") or "", "")
+    if len(result) > 50:
+        result = f"{result[:50]}..."
+    return f"[已调用工具 {function.get('name')}，结果: {result}]"
+
+
+def shape_context(messages: list[dict], full_turns: int) -> list[dict]:
+    """只为最近 full_turns 轮保留图片与完整的工具调用
+
+    更早的图片替换为文字占位（有缓存的描述时使用描述），工具调用与对应的工具结果
+    合并为一条简短的说明。一轮从一条 user 消息开始；full_turns <= 0 时不做处理。
+    """
+    if full_turns <= 0:
+        return messages
+    boundary = len(messages)
+    turns = 0
+    while boundary > 0 and turns < full_turns:
+        boundary -= 1
+        if messages[boundary]["role"] == "user":
+            turns += 1
+
+    results = {
+        m.get("tool_call_id") or "": str(m.get("content") or "")
+        for m in messages[:boundary]
+        if m["role"] == "tool"
+    }
+    shaped: list[dict] = []
+    for message in messages[:boundary]:
+        content = message.get("content")
+        if message["role"] == "tool":
+            continue
+        if tool_calls := message.get("tool_calls"):
+            notes = [_tool_note(call, results) for call in tool_calls]
+            shaped.append(
+                {
+                    "role": "assistant",
+                    "content": "\n".join([*filter(None, [content]), *notes]),
+                    "tool_call_id": None,
+                    "tool_calls": None,
+                }
+            )
+        elif isinstance(content, list):
+            shaped.append(
+                {
+                    **message,
+                    "content": "".join(
+                        part.get("text") or ""
+                        if part.get("type") == "text"
+                        else _image_stub(part.get("image_url", {}).get("url"))
+                        for part in content
+                    ),
+                }
+            )
+        else:
+            shaped.append(message)
+    return [*shaped, *messages[boundary:]]
@@ -1,26 +1,53 @@
 import asyncio
+from collections.abc import Callable, Iterable
 import datetime
 import os
 from pathlib import Path
 import random
+import time
+from typing import ClassVar
 
-from nonebot_plugin_alconna import AlconnaMatcher, Text, UniMessage, Video
+from nonebot_plugin_alconna import (
+    AlconnaMatcher,
+    Image,
+    Reply,
+    Text,
+    UniMessage,
+    Video,
+)
 from nonebot_plugin_apscheduler import scheduler
 from nonebot_plugin_uninfo import Uninfo
-from zai import ZhipuAiClient as ZhipuAI
-from zai.types.chat.chat_completion import CompletionMessage, CompletionMessageToolCall
+from zai.types.chat.chat_completion import (
+    CompletionMessage,
+    CompletionMessageToolCall,
+    Function,
+)
+from zai.types.chat.chat_completion_chunk import ChatCompletionChunk
 
 from zhenxun.configs.config import BotConfig, Config
 from zhenxun.configs.path_config import IMAGE_PATH
 from zhenxun.models.ban_console import BanConsole
-from zhenxun.models.chat_history import ChatHistory
 from zhenxun.services.log import logger
 from zhenxun.utils.rules import ensure_group
 
-from .config import IMPERSONATION_PROMPT, ChatConfig, get_prompt
+from .breaker import Breakers, is_transient
+from .buffer import GROUP_BUFFER
+from .cache import HistoryCache, HistoryEntry
+from .client import ZhipuClient
+from .config import IMPERSONATION_PROMPT, SUMMARY_PROMPT, ChatConfig, get_prompt
+from .context import build_context, token_budget
+from .executor import Executors
+from .images import ImageStore
+from .limiter import RateLimiter, is_rate_limited
+from .lock import CONVERSATION_LOCK
 from .model import ZhipuChatHistory, ZhipuResult
+from .router import ModelRouter
+from .stats import HistoryStats
 from .tools import ToolsManager
 from .utils import (
+    StreamSegmenter,
+    estimate_message_tokens,
+    estimate_tokens,
     extract_message_content,
     format_usr_msg,
     get_request_id,
@@ -28,37 +55,63 @@ from .utils import (
     get_username_by_session,
     msg2str,
 )
+from .writer import HISTORY_WRITER, HistoryWriteError
 
 # ==== 简单的内存缓存，用于减少 normal_chat 频繁扫数据库 ====
 
-# 每个 uid 的对话缓存：
-#   uid -> { "last_access": datetime, "data": list[dict] }
-_CHAT_HISTORY_CACHE: dict[str, dict] = {}
 # 缓存有效期：多久没有访问就认为过期，自动丢弃
 CHAT_HISTORY_TTL_SECONDS = 30 * 60  # 30 分钟
 # 每个 uid 最多保留多少条历史记录，防止内存无限增长
 CHAT_HISTORY_MAX_LEN = 200
+# 每个 uid 的对话缓存，按最近访问排序，并受全局条目数与内存上限约束
+_CHAT_HISTORY_CACHE = HistoryCache(CHAT_HISTORY_TTL_SECONDS)
+# 正在后台压缩历史的 uid
+_COMPACTING: set[str] = set()
+# 压缩失败后多久内不再为该 uid 压缩
+COMPACT_RETRY_SECONDS = 10 * 60
+# 压缩失败的 uid -> 允许再次压缩的时间
+_COMPACT_RETRY_AT: dict[str, float] = {}
+# 查看会话时每页的记录数
+HISTORY_PAGE_SIZE = 30
+
+
+def _to_message(record: dict) -> dict:
+    """将一条记录转换为与 get_history 返回格式一致的消息"""
+    return ZhipuChatHistory.to_message(
+        record["role"],
+        record["content"],
+        record.get("res_url"),
+        record.get("tool_calls"),
+        record.get("tool_call_id"),
+    )
 
 
 def _prune_history_cache() -> None:
     """清理超过 TTL 未访问的缓存，避免内存常驻过多 uid。"""
-    if not _CHAT_HISTORY_CACHE:
-        return
-    now = datetime.datetime.now()
-    to_delete = []
-    for uid, info in _CHAT_HISTORY_CACHE.items():
-        last_access: datetime.datetime = info.get("last_access", now)
-        if (now - last_access).total_seconds() > CHAT_HISTORY_TTL_SECONDS:
-            to_delete.append(uid)
-    for uid in to_delete:
-        _CHAT_HISTORY_CACHE.pop(uid, None)
-    if to_delete:
+    if count := _CHAT_HISTORY_CACHE.prune():
         logger.debug(
-            f"normal_chat 缓存清理: 移除 {len(to_delete)} 个 uid 的历史缓存",
+            f"normal_chat 缓存清理: 移除 {count} 个 uid 的历史缓存",
             "zhipu_toolkit",
         )
 
 
+def _trim_history(entry: HistoryEntry) -> None:
+    """截取最近 CHAT_HISTORY_MAX_LEN 条记录，并保证不以孤立的工具结果开头
+
+    开头的摘要记录始终保留。
+    """
+    history = entry.data
+    pinned = 0
+    while pinned < len(history) and history[pinned]["role"] == "system":
+        pinned += 1
+    start = max(len(history) - CHAT_HISTORY_MAX_LEN, pinned)
+    while start < len(history) and history[start]["role"] == "tool":
+        start += 1
+    if start > pinned:
+        entry.data = history[:pinned] + history[start:]
+        entry.tokens = entry.tokens[:pinned] + entry.tokens[start:]
+
+
 @scheduler.scheduled_job("interval", minutes=20, id="zhipu_normal_chat_cache_prune")
 async def _prune_history_cache_job() -> None:
     """定时任务：周期性清理 normal_chat 的内存缓存."""
@@ -84,9 +137,11 @@ async def check_video_task_status(task_id: str, action: type[AlconnaMatcher]):
     """定期检查视频生成任务状态，并在任务完成后自动结束"""
     while True:
         try:
-            client = ZhipuAI(api_key=ChatConfig.get("API_KEY"))
-            response = await asyncio.to_thread(
-                client.videos.retrieve_videos_result, id=task_id
+            # 轮询同样经过限流器，被限流时退避重试而不是结束轮询
+            response = await RateLimiter.run(
+                ChatConfig.get("VIDEO_MODEL"),
+                Executors.poll,
+                lambda: ZhipuClient.get().videos.retrieve_videos_result(id=task_id),
             )
 
             if response.task_status == "SUCCESS":
@@ -103,6 +158,48 @@ async def check_video_task_status(task_id: str, action: type[AlconnaMatcher]):
             raise e
 
 
+def _collect_stream(
+    chunks: Iterable[ChatCompletionChunk], on_delta: Callable[[str], None]
+) -> CompletionMessage:
+    """消费流式响应，逐段回调文本增量，并拼装为完整的 CompletionMessage
+
+    该函数在线程池中运行，`on_delta` 需自行保证线程安全。
+    """
+    content: list[str] = []
+    tool_calls: dict[int, dict[str, str]] = {}
+    for chunk in chunks:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+            on_delta(delta.content)
+        for call in delta.tool_calls or []:
+            entry = tool_calls.setdefault(
+                call.index, {"id": "", "name": "", "arguments": ""}
+            )
+            if call.id:
+                entry["id"] = call.id
+            if call.function is not None:
+                if call.function.name:
+                    entry["name"] = call.function.name
+                if call.function.arguments:
+                    entry["arguments"] += call.function.arguments
+    return CompletionMessage(
+        role="assistant",
+        content="".join(content),
+        tool_calls=[
+            CompletionMessageToolCall(
+                id=entry["id"],
+                type="function",
+                function=Function(name=entry["name"], arguments=entry["arguments"]),
+            )
+            for _, entry in sorted(tool_calls.items())
+        ]
+        or None,
+    )
+
+
 class ChatManager:
     @classmethod
     def _build_user_record(cls, content: str, res_url: str | None = None) -> dict:
@@ -147,7 +244,7 @@ class ChatManager:
 
     @classmethod
     async def _flush_round_history(cls, uid: str, records: list[dict]) -> None:
-        """将一轮对话（用户 + 模型返回 + 工具调用）写入数据库并同步更新缓存。
+        """将一轮对话（用户 + 模型返回 + 工具调用）交给写回队列并同步更新缓存。
 
         前提:
             - 调用方保证只有在模型返回结构正常时才调用。
@@ -155,51 +252,119 @@ class ChatManager:
         if not records:
             return
 
-        # 1. 顺序写入数据库
-        for rec in records:
-            await ZhipuChatHistory.create(
-                uid=uid,
-                role=rec["role"],
-                content=rec["content"],
-                res_url=rec.get("res_url"),
-                tool_calls=rec.get("tool_calls"),
-                tool_call_id=rec.get("tool_call_id"),
-            )
+        # 直接发送的图片链接会过期：本轮已随消息发出，写回的历史中只留下占位文本，
+        # 之后的轮次不再发送
+        records = [
+            {
+                **rec,
+                "content": f"{rec['content']}\n![#image:已发送过的图片]",
+                "res_url": None,
+            }
+            if rec.get("res_url") and not ImageStore.is_ref(rec["res_url"])
+            else rec
+            for rec in records
+        ]
+
+        # 1. 放入写回队列，由后台批量写入数据库
+        await HISTORY_WRITER.put(uid, records)
 
         # 2. 同步更新内存缓存
-        now = datetime.datetime.now()
-        cache_info = _CHAT_HISTORY_CACHE.get(uid)
-        if cache_info is None:
-            # 让下一次 get_chat_history 从 DB 重新加载即可
+        entry = _CHAT_HISTORY_CACHE.peek(uid)
+        if entry is None:
+            # 让下一次 get_chat_history 从 DB 重新加载即可（加载前会先写回队列）
             return
 
-        history: list = cache_info.get("data", [])
-        # 这里 history 的结构是 get_history 返回的那种形式：
-        # {"role":..., "content":(str or list[mix]),"tool_call_id":..., "tool_calls":...}  # noqa: E501
+        # 缓存中的结构与 get_history 返回的形式一致
         for rec in records:
-            if rec.get("res_url"):
-                content = [
-                    {"type": "text", "text": rec["content"]},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": rec["res_url"]},
-                    },
-                ]
-            else:
-                content = rec["content"]
-            history.append(
-                {
-                    "role": rec["role"],
-                    "content": content,
-                    "tool_call_id": rec.get("tool_call_id"),
-                    "tool_calls": rec.get("tool_calls"),
-                }
+            message = _to_message(rec)
+            entry.data.append(message)
+            entry.tokens.append(estimate_message_tokens(message))
+        _trim_history(entry)
+        _CHAT_HISTORY_CACHE.refresh(uid)
+        cls.schedule_compaction(uid, len(entry.data))
+
+    @classmethod
+    def schedule_compaction(cls, uid: str, size: int) -> None:
+        """历史条数超过阈值时，在后台压缩该 uid 最早的对话"""
+        threshold = int(ChatConfig.get("COMPACT_THRESHOLD") or 0)
+        if threshold <= 0 or size <= threshold or uid in _COMPACTING:
+            return
+        if time.monotonic() < _COMPACT_RETRY_AT.get(uid, 0):
+            return
+        _COMPACTING.add(uid)
+        task = asyncio.create_task(cls.compact_history(uid))
+        task.add_done_callback(lambda _: _COMPACTING.discard(uid))
+
+    @classmethod
+    async def compact_history(cls, uid: str) -> int:
+        """将 uid 最早的一段对话压缩为摘要记录，返回被压缩的记录数
+
+        失败时记录日志，并在 `COMPACT_RETRY_SECONDS` 内不再为该 uid 压缩。
+        """
+        try:
+            count = await cls._compact_history(uid)
+        except Exception as e:
+            logger.error(f"UID {uid} 压缩对话历史失败", "zhipu_toolkit", e=e)
+            _COMPACT_RETRY_AT[uid] = time.monotonic() + COMPACT_RETRY_SECONDS
+            return 0
+        _COMPACT_RETRY_AT.pop(uid, None)
+        return count
+
+    @classmethod
+    async def _compact_history(cls, uid: str) -> int:
+        """调用摘要模型时不持有会话锁，写回数据库与刷新缓存时与该 uid 的对话轮次串行"""
+        keep = max(int(ChatConfig.get("COMPACT_KEEP") or 0), 0)
+        await HISTORY_WRITER.flush()
+        rows = await ZhipuChatHistory.get_compactable(uid, keep)
+        if not rows:
+            return 0
+
+        transcript = "\n".join(
+            f"此前摘要: {content}" if role == "system" else f"[{role}] {content}"
+            for _, role, content in rows
+            if content
+        )
+        model = ChatConfig.get("SUMMARY_MODEL")
+        response = await RateLimiter.run(
+            model,
+            Executors.poll,
+            lambda: ZhipuClient.get().chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": transcript},
+                ],
+                user_id=uid,
+                request_id=get_request_id(),
+            ),
+            tokens=estimate_tokens(transcript),
+        )
+        summary = response.choices[0].message.content  # type: ignore
+        if not summary:
+            raise ValueError(f"摘要模型 {model} 返回了空内容")
+
+        summary = f"[对话摘要]\n{summary}"
+        async with CONVERSATION_LOCK.hold(uid):
+            count = await ZhipuChatHistory.compact(
+                uid, [row_id for row_id, _, _ in rows], summary
             )
-        cache_info["data"] = history[-CHAT_HISTORY_MAX_LEN:]
-        cache_info["last_access"] = now
+            _CHAT_HISTORY_CACHE.pop(uid)
+        if count:
+            HistoryStats.record_insert([{"uid": uid, "content": summary}])
+        logger.info(f"UID {uid} 已将 {count} 条对话压缩为摘要", "zhipu_toolkit")
+        return count
 
     @classmethod
-    async def normal_chat_result(cls, msg: UniMessage, session: Uninfo) -> str:
+    async def normal_chat_result(
+        cls,
+        msg: UniMessage,
+        session: Uninfo,
+        on_segment: Callable[[str], None] | None = None,
+    ) -> str:
+        """进行一轮对话并返回回答
+
+        :param on_segment: 传入时启用流式模式，每切出一段完整的回复就立即回调
+        """
         match ChatConfig.get("CHAT_MODE"):
             case "user":
                 uid = session.user.id
@@ -226,7 +391,43 @@ class ChatManager:
             )
             return f"超出管理员设置的字数限制: {word_limit}"
 
-        # 先把用户消息构造成记录，暂存内存
+        model = ModelRouter.route(
+            message,
+            has_image=img_url is not None or any(isinstance(s, Image) for s in msg),
+            has_reply=any(isinstance(s, Reply) for s in msg),
+        )
+        logger.debug(f"USER {uid} 本轮使用模型 {model}", "zhipu_toolkit")
+        async with CONVERSATION_LOCK.hold(uid):
+            return await cls._chat_round(
+                uid, model, username, message, img_url, session, on_segment
+            )
+
+    @classmethod
+    async def _chat_round(
+        cls,
+        uid: str,
+        model: str,
+        username: str,
+        message: str,
+        img_url: str | None,
+        session: Uninfo,
+        on_segment: Callable[[str], None] | None = None,
+    ) -> str:
+        """执行一轮对话，调用方需持有该 uid 的会话锁"""
+        segmenter = StreamSegmenter() if on_segment is not None else None
+
+        def on_delta(text: str) -> None:
+            assert segmenter is not None and on_segment is not None
+            for segment in segmenter.feed(text):
+                on_segment(segment)
+
+        def flush_segments() -> None:
+            if segmenter is not None and on_segment is not None:
+                for segment in segmenter.flush():
+                    on_segment(segment)
+
+        # 先把用户消息构造成记录，暂存内存；round_records 只用于写回，发送前由
+        # get_chat_history 转换为消息，直接发送的图片链接只在本轮随消息发出
         user_rec = cls._build_user_record(
             format_usr_msg(username, session, message), img_url
         )
@@ -234,9 +435,10 @@ class ChatManager:
         # 拿到当前历史（含 system prompt），发送给模型
         result = await cls.get_zhipu_result(
             uid,
-            ChatConfig.get("CHAT_MODEL"),
-            (await cls.get_chat_history(uid)) + round_records,
+            model,
+            await cls.get_chat_history(uid, model, round_records),
             session,
+            on_delta=on_delta if segmenter is not None else None,
         )
 
         # 内容审查 / 输入违规
@@ -264,6 +466,9 @@ class ChatManager:
             )
             return f"出错了: {result.content}"
 
+        # 第一次回复若带有 tool_calls，其前置文本也按段发出
+        flush_segments()
+
         # 模型第一次回复（可能带 tool_calls），先暂存
         round_records.append(cls._build_assistant_record(result.message))
 
@@ -281,11 +486,13 @@ class ChatManager:
             # 带工具结果，再次调用模型
             result = await cls.get_zhipu_result(
                 uid,
-                ChatConfig.get("CHAT_MODEL"),
-                await cls.get_chat_history(uid) + round_records,
+                model,
+                await cls.get_chat_history(uid, model, round_records),
                 session,
                 use_tool=False,
+                on_delta=on_delta if segmenter is not None else None,
             )
+            flush_segments()
 
             # 这里也只在返回结构正常时才追加到 round_records
             if result.error_code != 0 or result.message is None:
@@ -299,7 +506,11 @@ class ChatManager:
             round_records.append(cls._build_assistant_record(result.message))
 
         # 到这里，整轮对话都是“结构正常”的，可以一次性写入 DB + 缓存
-        await cls._flush_round_history(uid, round_records)
+        try:
+            await cls._flush_round_history(uid, round_records)
+        except HistoryWriteError as e:
+            logger.error(f"UID {uid} 保存对话记录失败", "zhipu_toolkit", e=e)
+            return f"出错了: {e}"
 
         answer = extract_message_content(result.content)
         logger.info(
@@ -312,67 +523,153 @@ class ChatManager:
     @classmethod
     async def clear_history(cls, uid: str | None = None) -> int:
         """清理历史记录，并同步清空内存缓存。"""
-        if uid is None:
-            _CHAT_HISTORY_CACHE.clear()
-        else:
-            _CHAT_HISTORY_CACHE.pop(uid, None)
-        return await ZhipuChatHistory.clear_history(uid)
+        if uid is not None:
+            return sum((await cls.clear_histories([uid])).values())
+        _CHAT_HISTORY_CACHE.clear()
+        discarded = await HISTORY_WRITER.discard()
+        deleted = await ZhipuChatHistory.clear_history()
+        HistoryStats.remove()
+        return sum(discarded.values()) + deleted
+
+    @classmethod
+    async def clear_histories(
+        cls, uids: list[str] | None = None, prefixes: list[str] | None = None
+    ) -> dict[str, int]:
+        """批量清理多个 uid 或指定前缀的历史记录，并同步清理内存缓存
+
+        :param prefixes: 不能为空字符串，清理全部记录请使用 `clear_history`
+        :return: 各 uid 被清理的记录数（含尚未写入数据库的记录）
+        """
+        if any(not prefix for prefix in prefixes or []):
+            raise ValueError("前缀不能为空")
+        targets = set(uids or [])
+        prefix_tuple = tuple(prefixes or [])
+
+        def match(uid: str) -> bool:
+            return uid in targets or uid.startswith(prefix_tuple)
+
+        _CHAT_HISTORY_CACHE.invalidate(match)
+        result = await HISTORY_WRITER.discard(match)
+        deleted = await ZhipuChatHistory.clear_histories(list(targets), prefixes)
+        for uid, count in deleted.items():
+            result[uid] = result.get(uid, 0) + count
+            HistoryStats.remove(uid)
+        return result
+
+    @classmethod
+    async def expire_history(cls, days: int) -> tuple[int, int, bool]:
+        """分批删除过期记录，并让受影响会话的缓存失效
+
+        每批在单独的事务中删除至多 `EXPIRE_BATCH_SIZE` 条，单次运行至多
+        `EXPIRE_MAX_BATCHES` 批，剩余的留给下一次运行。
+
+        :return: (删除的记录数, 涉及的会话数, 是否已清理完毕)
+        """
+        batch_size = max(int(ChatConfig.get("EXPIRE_BATCH_SIZE") or 500), 1)
+        max_batches = max(int(ChatConfig.get("EXPIRE_MAX_BATCHES") or 20), 1)
+        total = 0
+        uids: set[str] = set()
+        for _ in range(max_batches):
+            deleted = await ZhipuChatHistory.delete_old_records(days, batch_size)
+            for uid, count in deleted.items():
+                _CHAT_HISTORY_CACHE.pop(uid)
+                HistoryStats.record_delete(uid, count)
+            uids.update(deleted)
+            count = sum(deleted.values())
+            total += count
+            if count < batch_size:
+                return total, len(uids), True
+            # 批次之间让出事件循环与数据库，避免持续占用
+            await asyncio.sleep(0.2)
+        return total, len(uids), False
+
+    @classmethod
+    async def get_history_page(
+        cls, uid: str, before_id: int | None = None
+    ) -> tuple[list[dict], int | None]:
+        """按时间倒序分页读取 uid 的对话记录
+
+        :param before_id: 只读取id小于它的记录，为 None 时读取最新的一页
+        :return: (本页按时间顺序排列的记录, 读取更早一页时传入的 before_id，
+            没有更早的记录时为 None)
+        """
+        await HISTORY_WRITER.flush()
+        # 多读一条用于判断是否还有更早的记录
+        rows = await ZhipuChatHistory.get_history_page(
+            uid, before_id, HISTORY_PAGE_SIZE + 1
+        )
+        rows, more = rows[:HISTORY_PAGE_SIZE], len(rows) > HISTORY_PAGE_SIZE
+        return (
+            [message for _, message in reversed(rows)],
+            rows[-1][0] if more else None,
+        )
 
     @classmethod
-    async def get_chat_history(cls, uid: str) -> list[dict]:
-        """统一获取对话历史的入口，带内存缓存 + TTL。
+    def cache_report(cls) -> list[str]:
+        return _CHAT_HISTORY_CACHE.report()
+
+    @classmethod
+    async def get_chat_history(
+        cls, uid: str, model: str, pending: list[dict] | None = None
+    ) -> list[dict]:
+        """统一获取对话上下文的入口，带内存缓存 + TTL。
 
         行为:
-            - 若缓存中存在并且在 TTL 内，则直接返回缓存中的历史；
-            - 否则从数据库加载最近若干条记录，写入缓存并返回。
+            - 若缓存中存在并且在 TTL 内，则直接使用缓存中的历史；
+            - 否则从数据库加载最近若干条记录，写入缓存；
+            - 按模型的 token 预算，从最近的历史开始向前保留，组装 system prompt、
+              历史与本轮记录 pending；
+            - 只有最近 CONTEXT_FULL_TURNS 轮保留图片与完整的工具调用。
         """
-        now = datetime.datetime.now()
-        if cache_info := _CHAT_HISTORY_CACHE.get(uid):
-            last_access: datetime.datetime = cache_info.get("last_access", now)
-            if (now - last_access).total_seconds() <= CHAT_HISTORY_TTL_SECONDS:
-                # 缓存有效，更新访问时间并返回
-                cache_info["last_access"] = now
-                data: list = cache_info.get("data", [])
-                return [{"role": "system", "content": await get_prompt()}] + data
-
-        # 缓存不存在或已过期，从数据库获取完整历史
-        history = await ZhipuChatHistory.get_history(uid)
-        # 写入缓存，截断长度避免无限增长
-        _CHAT_HISTORY_CACHE[uid] = {
-            "last_access": now,
-            "data": history[-CHAT_HISTORY_MAX_LEN:],
-        }
-        return [{"role": "system", "content": await get_prompt()}] + history
+        entry = _CHAT_HISTORY_CACHE.get(uid)
+        if entry is None:
+            # 缓存不存在或已过期，先落库写回队列，再只从数据库读取最近的窗口
+            await HISTORY_WRITER.flush()
+            history = await ZhipuChatHistory.get_history(uid, CHAT_HISTORY_MAX_LEN)
+            entry = _CHAT_HISTORY_CACHE.put(
+                uid, history, [estimate_message_tokens(m) for m in history]
+            )
+
+        messages = build_context(
+            await get_prompt(),
+            entry.data,
+            entry.tokens,
+            # 本轮记录转换为与历史一致的消息格式，图片部分才会被计入预算并发送
+            [_to_message(record) for record in pending or []],
+            token_budget(model),
+            # 较早的轮次去掉图片与完整的工具调用，缩小请求体
+            int(ChatConfig.get("CONTEXT_FULL_TURNS") or 0),
+        )
+        # 图片在历史中只保存引用，仅为实际发送的消息读取图片内容
+        return await ImageStore.resolve(messages)
 
     @classmethod
-    async def call_impersonation_ai(cls, session: Uninfo):
+    async def call_impersonation_ai(
+        cls, session: Uninfo, is_stale: Callable[[], bool] | None = None
+    ):
+        """生成并发送伪人回复
+
+        :param is_stale: 发送前调用，返回 True 时说明上下文已过时，丢弃本次回复
+        """
         gid = session.scene.id
 
-        rows = (
-            await ChatHistory.filter(group_id=gid)
-            .order_by("-create_time")
-            .limit(20)
-            .values("bot_id", "user_id", "group_id", "create_time", "text")
-        )
-        if not rows:
+        records = await GROUP_BUFFER.recent(gid)
+        if not records:
             logger.warning(
-                f"数据库中未找到群 {gid} 的聊天记录",
+                f"未找到群 {gid} 的聊天记录",
                 command="zhipu_toolkit",
                 session=session,
             )
             return
 
-        # 本地缓存相同 (bot_id,user_id,group_id) 的用户名，避免重复查询
-        def _key_from_row(r):
-            return (r["bot_id"], r["user_id"], r["group_id"])
-
+        # 本地缓存相同 (bot_id,user_id) 的用户名，避免重复查询
         unique_keys = {}
         tasks = []
-        for r in rows:
-            key = _key_from_row(r)
+        for r in records:
+            key = (r.bot_id, r.user_id)
             if key not in unique_keys:
                 unique_keys[key] = None
-                tasks.append(get_username(*key))
+                tasks.append(get_username(r.bot_id, r.user_id, gid))
 
         # 并发获取所有不同用户的用户名
         if tasks:
@@ -383,9 +680,9 @@ class ChatManager:
 
         # 构建聊天记录字符串（列表收集，最后 join）
         parts = []
-        for r in rows:
-            uname = unique_keys[_key_from_row(r)]
-            parts.append(f"{r['create_time']} [{uname}]: {r['text']}")
+        for r in records:
+            uname = unique_keys[(r.bot_id, r.user_id)]
+            parts.append(f"{r.create_time} [{uname}]: {r.text}")
         CHAT_RECORDS = "\n\n".join(parts)
 
         prompt = IMPERSONATION_PROMPT.format(
@@ -419,9 +716,17 @@ class ChatManager:
         if answer is not None and "<EMPTY>" in answer:
             logger.info("伪人不需要回复，已被跳过", "zhipu_toolkit", session=session)
             return
+        if is_stale is not None and is_stale():
+            logger.debug(
+                f"群聊已有新消息，丢弃过时的伪人回复: {answer}",
+                "zhipu_toolkit",
+                session=session,
+            )
+            return
         logger.info(f"伪人回复: {answer}", "zhipu_toolkit", session=session)
         answer = extract_message_content(answer)
         await UniMessage(answer).send()
+        GROUP_BUFFER.append(gid, session.self_id, session.self_id, answer)
 
     @classmethod
     async def get_zhipu_result(
@@ -432,9 +737,14 @@ class ChatManager:
         session: Uninfo,
         impersonation: bool = False,
         use_tool: bool = True,
+        on_delta: Callable[[str], None] | None = None,
     ) -> ZhipuResult:
-        loop = asyncio.get_event_loop()
-        client = ZhipuAI(api_key=ChatConfig.get("API_KEY"))
+        """调用对话模型
+
+        :param on_delta: 传入时以流式方式请求，在事件循环中逐段回调文本增量
+        """
+        loop = asyncio.get_running_loop()
+        client = ZhipuClient.get()
         request_id = get_request_id()
         tools = (await ToolsManager.get_tools()) if use_tool else None
         tool_map = ToolsManager.tools_registry.keys() if tools else None
@@ -443,55 +753,158 @@ class ChatManager:
             "zhipu_toolkit",
             session=session,
         )
-        try:
-            response = await loop.run_in_executor(
-                None,
-                lambda: client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    user_id=uid,
-                    request_id=request_id,
-                    tools=tools,
-                ),
-            )
-        except Exception as e:
-            error = str(e)
-            if "user" in error:
-                if not impersonation:
-                    logger.warning(
-                        f"UID {uid} 用户输入内容触发内容审查: 封禁用户 {session.user.id} 5 分钟",  # noqa: E501
-                        "zhipu_toolkit",
-                        session=session,
-                    )
-                    await BanConsole.ban(
-                        session.user.id,
-                        session.scene.id if ensure_group(session) else None,
-                        9999,
-                        "输入内容违规",
-                        300,
-                    )
 
-                return ZhipuResult(
-                    content="输入内容包含不安全或敏感内容，你已被封禁5分钟",
-                    error_code=1,
+        emitted = False
+
+        def forward_delta(text: str) -> None:
+            nonlocal emitted
+            emitted = True
+            assert on_delta is not None
+            on_delta(text)
+
+        latency = 0.0
+
+        # timeout=None 表示不限时，未配置时不传入，使用客户端的默认超时
+        options: dict[str, float] = {}
+        if (timeout := float(ChatConfig.get("REQUEST_TIMEOUT") or 0)) > 0:
+            options["timeout"] = timeout
+
+        def request(candidate: str) -> CompletionMessage:
+            nonlocal latency
+            # 只统计模型本身的耗时，不含限流排队与退避
+            started = time.monotonic()
+            response = client.chat.completions.create(
+                model=candidate,
+                messages=messages,
+                user_id=uid,
+                request_id=request_id,
+                tools=tools,
+                stream=on_delta is not None,
+                **options,
+            )
+            if on_delta is None:
+                message = response.choices[0].message  # type: ignore
+            else:
+                message = _collect_stream(
+                    response,  # type: ignore
+                    lambda text: loop.call_soon_threadsafe(forward_delta, text),
                 )
-            elif "history" in error:
+            latency = time.monotonic() - started
+            return message
+
+        retries = max(int(ChatConfig.get("RETRY_TIMES") or 0), 0)
+        tokens = sum(estimate_message_tokens(m) for m in messages)
+        error = "所有模型均暂时不可用，请稍后再试"
+        for candidate in cls._model_chain(model):
+            breaker = Breakers.get(candidate)
+            if not breaker.allow():
+                logger.debug(f"模型 {candidate} 已熔断，跳过", "zhipu_toolkit")
+                continue
+            # 半开状态下本轮持有探测名额，以任何方式结束（包括被取消）都要归还
+            probe = breaker.probing
+            try:
+                for attempt in range(retries + 1):
+                    try:
+                        message = await RateLimiter.run(
+                            candidate,
+                            Executors.chat,
+                            lambda candidate=candidate: request(candidate),
+                            tokens=tokens,
+                        )
+                    except Exception as e:
+                        error = str(e)
+                        if is_rate_limited(e):
+                            breaker.release()
+                            logger.warning(
+                                f"UID {uid} 模型 {candidate} 持续被限流: {error}",
+                                "zhipu_toolkit",
+                                session=session,
+                            )
+                            error = "请求过于频繁，请稍后再试"
+                            break
+                        # 内容审查相关的错误绝不重试
+                        if (
+                            "user" in error
+                            or "history" in error
+                            or not is_transient(e)
+                        ):
+                            breaker.release()
+                            return await cls._handle_request_error(
+                                uid, error, session, impersonation
+                            )
+                        breaker.record_failure()
+                        logger.warning(
+                            f"UID {uid} 模型 {candidate} 请求失败"
+                            f"({attempt + 1}/{retries + 1}): {error}",
+                            "zhipu_toolkit",
+                            session=session,
+                        )
+                        # 流式回复已经发出部分内容时不能重试，否则会重复发送
+                        if emitted:
+                            return ZhipuResult(content=error, error_code=2)
+                        if attempt == retries or not breaker.allow():
+                            break
+                        probe = breaker.probing
+                        await asyncio.sleep(random.uniform(0, 0.5 * 2**attempt))
+                    else:
+                        breaker.record_success()
+                        ModelRouter.record(candidate, latency)
+                        if candidate != model:
+                            logger.info(
+                                f"UID {uid} 已回退至模型 {candidate}",
+                                "zhipu_toolkit",
+                                session=session,
+                            )
+                        return ZhipuResult(
+                            content=message.content, error_code=0, message=message
+                        )
+            finally:
+                if probe and breaker.probing:
+                    breaker.release()
+        return ZhipuResult(content=error, error_code=2)
+
+    @classmethod
+    def _model_chain(cls, model: str) -> list[str]:
+        """主模型在前、备用模型依次在后的调用顺序"""
+        fallbacks: list[str] = ChatConfig.get("FALLBACK_MODELS") or []
+        return list(dict.fromkeys([model, *fallbacks]))
+
+    @classmethod
+    async def _handle_request_error(
+        cls, uid: str, error: str, session: Uninfo, impersonation: bool
+    ) -> ZhipuResult:
+        """处理不可重试的错误，内容审查相关的错误在此分流"""
+        if "user" in error:
+            if not impersonation:
                 logger.warning(
-                    f"UID {uid} 对话历史记录触发内容审查: 清理历史记录",
+                    f"UID {uid} 用户输入内容触发内容审查: 封禁用户 {session.user.id} 5 分钟",  # noqa: E501
                     "zhipu_toolkit",
                     session=session,
                 )
-                await cls.clear_history(uid)
-                return ZhipuResult(
-                    content="对话记录包含违规内容已被清除，请重新开始对话", error_code=1
+                await BanConsole.ban(
+                    session.user.id,
+                    session.scene.id if ensure_group(session) else None,
+                    9999,
+                    "输入内容违规",
+                    300,
                 )
-            else:
-                return ZhipuResult(content=error, error_code=2)
-        return ZhipuResult(
-            content=response.choices[0].message.content,  # type: ignore
-            error_code=0,
-            message=response.choices[0].message,  # type: ignore
-        )
+
+            return ZhipuResult(
+                content="输入内容包含不安全或敏感内容，你已被封禁5分钟",
+                error_code=1,
+            )
+        elif "history" in error:
+            logger.warning(
+                f"UID {uid} 对话历史记录触发内容审查: 清理历史记录",
+                "zhipu_toolkit",
+                session=session,
+            )
+            await cls.clear_history(uid)
+            return ZhipuResult(
+                content="对话记录包含违规内容已被清除，请重新开始对话", error_code=1
+            )
+        else:
+            return ZhipuResult(content=error, error_code=2)
 
     @classmethod
     async def parse_function_call(
@@ -522,6 +935,61 @@ class ChatManager:
                 return
 
 
+class _ImpersonationState:
+    __slots__ = ("dirty", "session", "task")
+
+    def __init__(self, session: Uninfo) -> None:
+        self.session = session
+        self.dirty = False
+        self.task: asyncio.Task | None = None
+
+
+class ImpersonationScheduler:
+    """按群合并伪人模式的触发
+
+    每个群同时至多有一次伪人请求：请求进行中再次触发只会标记为 dirty，当前请求结束后
+    再基于最新的上下文补一次；触发后先等待 `IMPERSONATION_DEBOUNCE` 秒合并连续的消息。
+    读取上下文后又收到超过 `IMPERSONATION_STALE_MESSAGES` 条消息时，回复被视为过时并
+    丢弃。
+    """
+
+    _states: ClassVar[dict[str, _ImpersonationState]] = {}
+
+    @classmethod
+    def trigger(cls, session: Uninfo) -> None:
+        gid = session.scene.id
+        if (state := cls._states.get(gid)) is not None:
+            state.session = session
+            state.dirty = True
+            return
+        state = cls._states[gid] = _ImpersonationState(session)
+        state.task = asyncio.create_task(cls._run(gid, state))
+
+    @classmethod
+    async def _run(cls, gid: str, state: _ImpersonationState) -> None:
+        debounce = float(ChatConfig.get("IMPERSONATION_DEBOUNCE") or 0)
+        max_new = int(ChatConfig.get("IMPERSONATION_STALE_MESSAGES") or 0)
+        try:
+            while True:
+                await asyncio.sleep(debounce)
+                state.dirty = False
+                version = GROUP_BUFFER.version(gid)
+                try:
+                    await ChatManager.call_impersonation_ai(
+                        state.session,
+                        lambda: max_new > 0
+                        and GROUP_BUFFER.version(gid) - version > max_new,
+                    )
+                except Exception as e:
+                    logger.error(
+                        "伪人回复失败", "zhipu_toolkit", session=state.session, e=e
+                    )
+                if not state.dirty:
+                    return
+        finally:
+            cls._states.pop(gid, None)
+
+
 class ImpersonationStatus:
     @classmethod
     async def check(cls, session: Uninfo) -> bool:
@@ -0,0 +1,127 @@
+import asyncio
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import Any, ClassVar, TypeVar
+
+import nonebot
+
+from .config import ChatConfig
+
+T = TypeVar("T")
+
+driver = nonebot.get_driver()
+
+
+class WorkloadExecutor:
+    """按负载类型划分的有界线程池
+
+    智谱 SDK 只提供同步接口，阻塞调用需在线程池中执行。不同负载使用独立的线程池，
+    避免生成图片/视频等慢任务占满线程而拖慢对话回复。
+    """
+
+    def __init__(self, name: str, config_key: str, default_size: int) -> None:
+        self.name = name
+        self.config_key = config_key
+        self.default_size = default_size
+        self._executor: ThreadPoolExecutor | None = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._waits: deque[float] = deque(maxlen=200)
+
+    @property
+    def size(self) -> int:
+        return max(int(ChatConfig.get(self.config_key) or self.default_size), 1)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        size = self.size
+        if self._executor is None or size != self._size:
+            # 配置变更时替换线程池，旧线程池中的任务会继续执行完毕
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(
+                max_workers=size, thread_name_prefix=f"zhipu-{self.name}"
+            )
+            self._size = size
+        return self._executor
+
+    async def run(self, func: Callable[..., T], /, *args: Any, **kwargs: Any) -> T:
+        """在该线程池中执行阻塞函数"""
+        loop = asyncio.get_running_loop()
+        submitted = time.monotonic()
+        with self._lock:
+            self._queued += 1
+
+        def wrapped() -> T:
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._waits.append(time.monotonic() - submitted)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+
+        return await loop.run_in_executor(self._get_executor(), wrapped)
+
+    def stats(self) -> dict[str, Any]:
+        """线程池的排队深度与等待耗时统计"""
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "size": self._size or self.size,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "wait_max": waits[-1] if waits else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class Executors:
+    chat: ClassVar = WorkloadExecutor("chat", "CHAT_WORKERS", 8)
+    """对话"""
+    vision: ClassVar = WorkloadExecutor("vision", "VISION_WORKERS", 4)
+    """图像理解"""
+    media: ClassVar = WorkloadExecutor("media", "MEDIA_WORKERS", 2)
+    """图片/视频生成"""
+    poll: ClassVar = WorkloadExecutor("poll", "POLL_WORKERS", 2)
+    """后台任务（视频状态轮询、历史压缩）"""
+    image: ClassVar = WorkloadExecutor("image", "IMAGE_WORKERS", 2)
+    """图片解码与缩放"""
+
+    @classmethod
+    def all(cls) -> list[WorkloadExecutor]:
+        return [cls.chat, cls.vision, cls.media, cls.poll, cls.image]
+
+    @classmethod
+    def report(cls) -> list[str]:
+        lines = ["[线程池]"]
+        for executor in cls.all():
+            s = executor.stats()
+            lines.append(
+                f"{executor.name}: {s['running']}/{s['size']} 运行中, "
+                f"排队 {s['queued']}, 已完成 {s['completed']}, "
+                f"等待 avg {s['wait_avg'] * 1000:.0f}ms "
+                f"p95 {s['wait_p95'] * 1000:.0f}ms max {s['wait_max'] * 1000:.0f}ms"
+            )
+        return lines
+
+
+@driver.on_shutdown
+async def _shutdown_executors() -> None:
+    for executor in Executors.all():
+        executor.shutdown()
@@ -1,16 +1,14 @@
 import asyncio
 import re
 
-from nonebot import on_message, require
+from nonebot import on_message, on_notice, require
 from nonebot_plugin_apscheduler import scheduler
-from zai import ZhipuAiClient as ZhipuAI
 
 from zhenxun.services.log import logger
 from zhenxun.utils.message import MessageUtils
 from zhenxun.utils.rules import ensure_group
 
-from .model import ZhipuChatHistory
-from .utils import get_request_id, split_text
+from .utils import get_request_id, segment_delay, split_text
 
 require("nonebot_plugin_alconna")
 require("nonebot_plugin_uninfo")
@@ -33,33 +31,51 @@ from nonebot_plugin_alconna import (
 from nonebot_plugin_alconna.uniseg.tools import reply_fetch
 from nonebot_plugin_uninfo import ADMIN, Uninfo
 
+from .breaker import Breakers
+from .buffer import GROUP_BUFFER
+from .client import ZhipuClient
 from .config import ChatConfig, get_prompt
+from .executor import Executors
+from .images import DescriptionCache
+from .limiter import RateLimiter
+from .lock import CONVERSATION_LOCK
 from .data_source import (
     ChatManager,
+    ImpersonationScheduler,
     ImpersonationStatus,
     check_video_task_status,
     hello,
 )
+from .roster import GROUP_ROSTER
+from .router import ModelRouter
 from .rule import need_byd, need_reply
+from .stats import HistoryStats
+from .writer import HISTORY_WRITER
 
 INIT = True
 
 
 @scheduler.scheduled_job(
-    "cron",
-    hour=0,
-    minute=0,
+    "interval",
+    minutes=10,
+    id="zhipu_expire_chat_history",
 )
 async def delete_expired_chat_history():
     day = ChatConfig.get("EXPIRE_DAY")
     if day < 0:
-        logger.info("跳过清理过期会话任务: 用户设置永不过期", "zhipu_toolkit")
+        logger.debug("跳过清理过期会话任务: 用户设置永不过期", "zhipu_toolkit")
         return
     try:
-        deleted = await ZhipuChatHistory.delete_old_records(day)
-        logger.info(f"成功清理 {deleted} 条过期会话 记录", "zhipu_toolkit")
+        deleted, uids, finished = await ChatManager.expire_history(day)
     except Exception as e:
         logger.error("清理过期会话记录失败", "zhipu_toolkit", e=e)
+        return
+    if deleted:
+        logger.info(
+            f"清理 {deleted} 条过期会话记录, 涉及 {uids} 个会话, "
+            + ("已清理完毕" if finished else "剩余记录将在下次任务中继续清理"),
+            "zhipu_toolkit",
+        )
 
 
 draw_pic = on_alconna(
@@ -93,6 +109,12 @@ chat = on_message(priority=999, block=True, rule=need_reply)
 
 byd_chat = on_message(priority=1000, block=True, rule=need_byd)
 
+# 只记录群消息供伪人模式使用，不阻断后续响应；使用最高优先级是为了在命令等
+# 阻断的响应器之前执行，否则这些消息不会进入缓冲
+record_group_msg = on_message(priority=1, block=False, rule=ensure_group)
+
+roster_notice = on_notice(priority=1, block=False)
+
 clear_my_chat = on_alconna(Alconna("清理我的会话"), priority=5, block=True)
 
 clear_all_chat = on_alconna(
@@ -121,10 +143,17 @@ clear_chat = on_alconna(
     block=True,
 )
 
+show_status = on_alconna(
+    Alconna("查看AI状态"),
+    permission=SUPERUSER,
+    priority=5,
+    block=True,
+)
+
 show_chat = on_alconna(
     Alconna(
         "查看会话",
-        Args["target?", str | int | At],
+        Args["target?", str | int | At]["before?", int],
         meta=CommandMeta(compact=True),
     ),
     permission=ADMIN() | SUPERUSER,
@@ -145,12 +174,15 @@ async def _(result: Arparma):
     prompt = "\n".join(map(str, result.query("msg")))  # type: ignore
 
     try:
-        client = ZhipuAI(api_key=ChatConfig.get("API_KEY"))
-        response = await asyncio.to_thread(
-            client.images.generations,
-            model=ChatConfig.get("PIC_MODEL"),
-            prompt=prompt,
-            size=result.query("size"),
+        model = ChatConfig.get("PIC_MODEL")
+        response = await RateLimiter.run(
+            model,
+            Executors.media,
+            lambda: ZhipuClient.get().images.generations(
+                model=model,
+                prompt=prompt,
+                size=result.query("size"),
+            ),
         )
         await draw_pic.send(Image(url=response.data[0].url), reply_to=True)
     except Exception as e:
@@ -180,14 +212,17 @@ async def _(result: Arparma):
             "",
         )
 
-        client = ZhipuAI(api_key=ChatConfig.get("API_KEY"))
-        response = await asyncio.to_thread(
-            client.videos.generations,
-            model=ChatConfig.get("VIDEO_MODEL"),
-            image_url=image_url,
-            prompt=non_image_str,
-            with_audio=True,
-            request_id=get_request_id(),
+        model = ChatConfig.get("VIDEO_MODEL")
+        response = await RateLimiter.run(
+            model,
+            Executors.media,
+            lambda: ZhipuClient.get().videos.generations(
+                model=model,
+                image_url=image_url,
+                prompt=non_image_str,
+                with_audio=True,
+                request_id=get_request_id(),
+            ),
         )
 
         if response.task_status == "FAIL":
@@ -256,7 +291,22 @@ async def _(bot, event: Event, msg: UniMsg, session: Uninfo):
                 image = item
                 break
 
-    result = await ChatManager.normal_chat_result(image + msg, session)
+    if ChatConfig.get("STREAM_MODE"):
+        queue: asyncio.Queue[str | None] = asyncio.Queue()
+        sender = asyncio.create_task(_send_stream_segments(queue, use_reply))
+        try:
+            result = await ChatManager.normal_chat_result(
+                image + msg, session, on_segment=queue.put_nowait
+            )
+        finally:
+            queue.put_nowait(None)
+            sent = await sender
+        if result.startswith("出错了"):
+            await UniMessage(Text(result)).finish(reply_to=True)
+        if sent:
+            return
+    else:
+        result = await ChatManager.normal_chat_result(image + msg, session)
 
     if result.startswith("出错了"):
         await UniMessage(Text(result)).finish(reply_to=True)
@@ -266,10 +316,39 @@ async def _(bot, event: Event, msg: UniMsg, session: Uninfo):
         await asyncio.sleep(delay)
 
 
+async def _send_stream_segments(queue: asyncio.Queue[str | None], use_reply: bool):
+    """逐段发送流式回复，返回已发送的段数"""
+    loop = asyncio.get_running_loop()
+    sent = 0
+    next_send_at = loop.time()
+    while (segment := await queue.get()) is not None:
+        await asyncio.sleep(max(next_send_at - loop.time(), 0))
+        await UniMessage(Text(segment)).send(reply_to=use_reply)
+        sent += 1
+        next_send_at = loop.time() + segment_delay(segment)
+    return sent
+
+
+@record_group_msg.handle()
+async def _(session: Uninfo, msg: UniMsg):
+    # 未开启伪人模式的群不需要缓冲
+    if not await ImpersonationStatus.check(session):
+        return
+    GROUP_BUFFER.append(
+        session.scene.id, session.self_id, session.user.id, msg.extract_plain_text()
+    )
+
+
+@roster_notice.handle()
+async def _(event: Event):
+    GROUP_ROSTER.handle_notice(event)
+
+
 @byd_chat.handle()
 async def _(session: Uninfo):
     if await ImpersonationStatus.check(session) and ChatConfig.get("API_KEY"):
-        return asyncio.create_task(ChatManager.call_impersonation_ai(session))
+        ImpersonationScheduler.trigger(session)
+        return
 
     # 伪人模式未启用
     logger.debug("伪人模式被禁用 skip...", "zhipu_toolkit", session=session)
@@ -312,11 +391,25 @@ async def _(param: Arparma):
         else:
             targets.append(str(t))
 
-    tasks = [ChatManager.clear_history(t) for t in targets]
-    results = await asyncio.gather(*tasks)
-    counts = dict(zip(targets, results))
-
-    result = [Text(f"• {t}: {count} 条数据\n") for t, count in counts.items()]
+    # 以 * 结尾的目标视为前缀，如 g-* 清理全部群聊会话
+    prefixes = [t[:-1] for t in targets if t.endswith("*")]
+    if "" in prefixes:
+        await clear_chat.finish(
+            Text("* 前至少需要一个字符，清理全部会话请使用 清理全部会话"),
+            reply_to=True,
+        )
+    uids = [t for t in targets if not t.endswith("*")]
+    counts = await ChatManager.clear_histories(uids, prefixes)
+
+    result = [Text(f"• {t}: {counts.get(t, 0)} 条数据\n") for t in uids]
+    for prefix in prefixes:
+        matched = [uid for uid in counts if uid.startswith(prefix)]
+        result.append(
+            Text(
+                f"• {prefix}*: {len(matched)} 个会话, "
+                f"{sum(counts[uid] for uid in matched)} 条数据\n"
+            )
+        )
     summary = Text(f"已清理 {len(targets)} 个目标的聊天记录：\n")
     messages = [summary, *result]
 
@@ -335,10 +428,13 @@ async def _(param: Arparma):
         else:
             target = str(p)
 
+    before: int | None = param.query("before")
+    next_before = None
     if target is None:
-        data = await ZhipuChatHistory.get_user_list()
+        await HISTORY_WRITER.flush()
+        data = await HistoryStats.list()
     else:
-        data = await ZhipuChatHistory.get_history(target)
+        data, next_before = await ChatManager.get_history_page(target, before)
     for i in data:
         if isinstance(i, dict):
             assert isinstance(target, str)
@@ -360,11 +456,40 @@ async def _(param: Arparma):
             if i["role"] == "tool":
                 node_list.append(f"工具 {i['tool_call_id']} 调用成功:\n{i['content']}")
         else:
+            uid, stats = i
+            last_active = (
+                stats.last_active.strftime("%Y-%m-%d %H:%M:%S")
+                if stats.last_active
+                else "未知"
+            )
             node_list.append(
-                f"用户 {i[0]} 的记录数: {i[1]}",
+                f"用户 {uid} 的记录数: {stats.count}\n"
+                f"最后活跃: {last_active}\n"
+                f"约占用: {stats.size / 1024:.1f}KB",
             )
     if not node_list:
         await show_chat.finish(Text("没有找到相关记录..."), reply_to=True)
+    if target is not None:
+        node_list.append(
+            f"发送 查看会话 {target} {next_before} 查看更早的记录"
+            if next_before is not None
+            else "已是最早的记录"
+        )
     if len(node_list) > 90:
         node_list = [*node_list[:90], Text(f"...省略{len(node_list[91:])}条对话记录")]
     await MessageUtils.alc_forward_msg(node_list, "80000000", "匿名消息").send()
+
+
+@show_status.handle()
+async def _():
+    lines = [
+        *Executors.report(),
+        *RateLimiter.report(),
+        *Breakers.report(),
+        *ModelRouter.report(),
+        *HISTORY_WRITER.report(),
+        *ChatManager.cache_report(),
+        *DescriptionCache.report(),
+        *CONVERSATION_LOCK.report(),
+    ]
+    await show_status.send(Text("\n".join(lines)), reply_to=True)
@@ -0,0 +1,380 @@
+import asyncio
+import base64
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Coroutine
+import contextlib
+import hashlib
+import io
+import os
+import time
+import uuid
+
+import aiofiles
+import httpx
+import nonebot
+from nonebot_plugin_apscheduler import scheduler
+from PIL import Image, ImageOps
+
+from zhenxun.configs.path_config import DATA_PATH
+from zhenxun.services.log import logger
+
+from .config import ChatConfig
+from .executor import Executors
+from .model import ZhipuImageDescription
+
+driver = nonebot.get_driver()
+
+IMAGE_DIR = DATA_PATH / "zhipu_toolkit" / "images"
+IMAGE_DIR.mkdir(parents=True, exist_ok=True)
+
+REF_PREFIX = "sha256:"
+"""对话记录中图片引用的前缀，其后为图片内容的 sha256"""
+
+
+class ImageTooLarge(Exception):
+    """图片超过 `IMAGE_MAX_MB` 限制"""
+
+
+def _downscale(data: bytes) -> bytes:
+    """将图片缩放到 `IMAGE_MAX_EDGE` 以内并重新编码，尺寸已符合时原样返回"""
+    max_edge = int(ChatConfig.get("IMAGE_MAX_EDGE") or 0)
+    with Image.open(io.BytesIO(data)) as image:
+        if max_edge <= 0 or max(image.size) <= max_edge:
+            return data
+        # 动图只保留第一帧
+        image.seek(0)
+        frame = ImageOps.exif_transpose(image) or image
+        frame.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        has_alpha = frame.mode in ("RGBA", "LA") or (
+            frame.mode == "P" and "transparency" in frame.info
+        )
+        if has_alpha:
+            frame.save(output, "PNG", optimize=True)
+        else:
+            frame.convert("RGB").save(
+                output,
+                "JPEG",
+                quality=int(ChatConfig.get("IMAGE_QUALITY") or 85),
+                optimize=True,
+            )
+        return output.getvalue()
+
+
+class ImageStore:
+    """按内容寻址的图片存储
+
+    图片以内容 sha256 命名保存在 `IMAGE_DIR` 下，相同的图片只保存一份；对话记录中只
+    保存 `sha256:<hash>` 形式的引用，发送给模型前再读取并编码为 base64。
+    """
+
+    _encoded: OrderedDict[str, str] = OrderedDict()
+    """最近发送过的图片的 base64，连续多轮对话无需重复读取"""
+    _max_encoded = 32
+
+    @staticmethod
+    def is_ref(value: str | None) -> bool:
+        return value is not None and value.startswith(REF_PREFIX)
+
+    @staticmethod
+    def _path(digest: str):
+        return IMAGE_DIR / digest[:2] / digest
+
+    @classmethod
+    async def save(cls, data: bytes) -> str:
+        """保存图片并返回其引用，已存在时只刷新修改时间"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = cls._path(digest)
+        if path.exists():
+            # 修改时间用于判断图片是否仍被未过期的记录引用
+            with contextlib.suppress(OSError):
+                os.utime(path)
+            return REF_PREFIX + digest
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{digest}.{uuid.uuid4().hex}.tmp")
+        async with aiofiles.open(tmp, "wb") as f:
+            await f.write(data)
+        tmp.replace(path)
+        return REF_PREFIX + digest
+
+    @classmethod
+    async def load_base64(cls, ref: str) -> str | None:
+        """读取引用对应的图片并编码为 base64，图片不存在时返回 None"""
+        digest = ref.removeprefix(REF_PREFIX)
+        if (encoded := cls._encoded.get(digest)) is not None:
+            cls._encoded.move_to_end(digest)
+            return encoded
+        try:
+            async with aiofiles.open(cls._path(digest), "rb") as f:
+                encoded = base64.b64encode(await f.read()).decode()
+        except FileNotFoundError:
+            return None
+        cls._encoded[digest] = encoded
+        while len(cls._encoded) > cls._max_encoded:
+            cls._encoded.popitem(last=False)
+        return encoded
+
+    @classmethod
+    async def resolve(cls, messages: list[dict]) -> list[dict]:
+        """将消息中的图片引用替换为 base64，只处理实际要发送的消息
+
+        图片文件已被清理的消息只保留文字部分。
+        """
+        resolved = []
+        for message in messages:
+            content = message.get("content")
+            if not isinstance(content, list) or not any(
+                part.get("type") == "image_url"
+                and cls.is_ref(part["image_url"].get("url"))
+                for part in content
+            ):
+                resolved.append(message)
+                continue
+            parts = []
+            for part in content:
+                url = part.get("image_url", {}).get("url")
+                if part.get("type") != "image_url" or not cls.is_ref(url):
+                    parts.append(part)
+                elif (encoded := await cls.load_base64(url)) is not None:
+                    parts.append({"type": "image_url", "image_url": {"url": encoded}})
+            if len(parts) == 1 and parts[0].get("type") == "text":
+                resolved.append({**message, "content": parts[0]["text"]})
+            else:
+                resolved.append({**message, "content": parts})
+        return resolved
+
+    @staticmethod
+    def _prune_files(cutoff: float) -> list[str]:
+        """删除修改时间早于 cutoff 的图片文件，返回被删除图片的 sha256"""
+        removed = []
+        for path in IMAGE_DIR.glob("*/*"):
+            with contextlib.suppress(OSError):
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed.append(path.name)
+        return removed
+
+    @classmethod
+    async def prune(cls, days: int) -> int:
+        """删除超过 days 天未被引用的图片，返回删除的数量"""
+        # 遍历整个图片目录的文件操作放到线程池中，不阻塞事件循环
+        removed = await Executors.image.run(
+            cls._prune_files, time.time() - days * 86400
+        )
+        for digest in removed:
+            cls._encoded.pop(digest, None)
+        return len(removed)
+
+
+class ImageFetcher:
+    """多模态输入图片的下载管道
+
+    流式下载并在超过 `IMAGE_MAX_MB` 时立即中止，解码与缩放在 `Executors.image` 中执行，
+    同时进行的下载数受 `IMAGE_FETCH_CONCURRENCY` 限制。
+    """
+
+    _client: httpx.AsyncClient | None = None
+    _semaphore: asyncio.Semaphore | None = None
+    _limit = 0
+
+    @classmethod
+    def _get_client(cls) -> httpx.AsyncClient:
+        if cls._client is None:
+            cls._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30, connect=10), follow_redirects=True
+            )
+        return cls._client
+
+    @classmethod
+    def _get_semaphore(cls) -> asyncio.Semaphore:
+        limit = max(int(ChatConfig.get("IMAGE_FETCH_CONCURRENCY") or 4), 1)
+        if cls._semaphore is None or cls._limit != limit:
+            cls._semaphore = asyncio.Semaphore(limit)
+            cls._limit = limit
+        return cls._semaphore
+
+    @classmethod
+    async def download(cls, url: str) -> bytes:
+        """下载图片，超过大小限制时抛出 ImageTooLarge"""
+        max_bytes = int(float(ChatConfig.get("IMAGE_MAX_MB") or 0) * 1024 * 1024)
+        async with (
+            cls._get_semaphore(),
+            cls._get_client().stream("GET", url) as response,
+        ):
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if max_bytes > 0 and length and int(length) > max_bytes:
+                raise ImageTooLarge(url)
+            buffer = bytearray()
+            async for chunk in response.aiter_bytes():
+                buffer += chunk
+                if max_bytes > 0 and len(buffer) > max_bytes:
+                    raise ImageTooLarge(url)
+            return bytes(buffer)
+
+    @classmethod
+    async def fetch(cls, url: str) -> str:
+        """下载、缩放并保存图片，返回图片引用"""
+        data = await cls.download(url)
+        return await ImageStore.save(await Executors.image.run(_downscale, data))
+
+    @classmethod
+    async def close(cls) -> None:
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+
+
+class DescriptionCache:
+    """图片描述缓存
+
+    以图片内容的 sha256 为主键持久化到数据库，图片链接作为辅助键，已知的链接无需下载；
+    内存与数据库均按最近使用淘汰（数据库每小时裁剪至 `IMAGE_DESC_CACHE_SIZE` 条）。
+    同一链接的并发请求共享一次下载，同一张图片的并发请求共享一次图像理解调用。
+    """
+
+    _max_memory = 512
+    _by_digest: OrderedDict[str, str] = OrderedDict()
+    _by_url: OrderedDict[str, str] = OrderedDict()
+    _resolving: dict[str, asyncio.Task[str]] = {}
+    """按链接合并的请求"""
+    _inflight: dict[str, asyncio.Task[str]] = {}
+    """按图片内容合并的图像理解调用"""
+    hits = 0
+    misses = 0
+    shared = 0
+
+    @classmethod
+    def _remember(cls, cache: OrderedDict[str, str], key: str, value: str) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > cls._max_memory:
+            cache.popitem(last=False)
+
+    @classmethod
+    def peek(cls, digest: str) -> str | None:
+        """只从内存中读取描述，不触发生成"""
+        return cls._by_digest.get(digest)
+
+    @staticmethod
+    def _join(
+        tasks: dict[str, asyncio.Task[str]],
+        key: str,
+        factory: Callable[[], Coroutine[None, None, str]],
+    ) -> tuple[asyncio.Task[str], bool]:
+        """获取 key 对应的进行中任务，不存在时创建，返回 (任务, 是否为已有任务)"""
+        if (task := tasks.get(key)) is not None:
+            return task, True
+        task = tasks[key] = asyncio.create_task(factory())
+        task.add_done_callback(lambda _: tasks.pop(key, None))
+        return task, False
+
+    @classmethod
+    async def get(cls, url: str, describe: Callable[[str], Awaitable[str]]) -> str:
+        """获取图片描述，未命中时调用 describe(url) 生成"""
+        if (digest := cls._by_url.get(url)) is not None and (
+            description := cls._by_digest.get(digest)
+        ) is not None:
+            cls._by_digest.move_to_end(digest)
+            cls.hits += 1
+            return description
+        task, shared = cls._join(
+            cls._resolving, url, lambda: cls._resolve(url, describe)
+        )
+        if shared:
+            cls.shared += 1
+        # 调用方被取消时不影响其他等待同一张图片的请求
+        return await asyncio.shield(task)
+
+    @classmethod
+    async def _resolve(
+        cls, url: str, describe: Callable[[str], Awaitable[str]]
+    ) -> str:
+        try:
+            found = await ZhipuImageDescription.lookup_url(url)
+        except Exception as e:
+            logger.warning("读取图片描述缓存失败", "zhipu_toolkit", e=e)
+            found = None
+        if found is not None:
+            digest, description = found
+            cls._remember(cls._by_url, url, digest)
+            cls._remember(cls._by_digest, digest, description)
+            cls.hits += 1
+            return description
+        try:
+            digest = hashlib.sha256(await ImageFetcher.download(url)).hexdigest()
+        except Exception as e:
+            # 无法读取内容时不缓存，交给模型直接读取链接
+            logger.debug(f"下载图片失败，跳过描述缓存: {url}", "zhipu_toolkit", e=e)
+            cls.misses += 1
+            return await describe(url)
+        cls._remember(cls._by_url, url, digest)
+        if (description := cls._by_digest.get(digest)) is not None:
+            cls._by_digest.move_to_end(digest)
+            cls.hits += 1
+            return description
+        # 内容相同而链接不同的图片共享一次图像理解调用
+        task, shared = cls._join(
+            cls._inflight, digest, lambda: cls._fill(digest, url, describe)
+        )
+        if shared:
+            cls.shared += 1
+        return await asyncio.shield(task)
+
+    @classmethod
+    async def _fill(
+        cls, digest: str, url: str, describe: Callable[[str], Awaitable[str]]
+    ) -> str:
+        try:
+            description = await ZhipuImageDescription.lookup(digest)
+        except Exception as e:
+            logger.warning("读取图片描述缓存失败", "zhipu_toolkit", e=e)
+            description = None
+        if description is not None:
+            cls.hits += 1
+        else:
+            cls.misses += 1
+            description = await describe(url)
+            if not description:
+                return description
+        try:
+            # 同时记录本次的链接，之后遇到同一链接时无需下载
+            await ZhipuImageDescription.store(digest, url, description)
+        except Exception as e:
+            logger.warning("保存图片描述缓存失败", "zhipu_toolkit", e=e)
+        cls._remember(cls._by_digest, digest, description)
+        return description
+
+    @classmethod
+    def report(cls) -> list[str]:
+        total = cls.hits + cls.misses
+        rate = cls.hits / total if total else 0.0
+        return [
+            "[图片描述缓存]",
+            f"{len(cls._by_digest)} 条在内存, 命中 {cls.hits} / 未命中 {cls.misses} "
+            f"({rate:.1%}), 合并并发请求 {cls.shared} 次",
+        ]
+
+
+@scheduler.scheduled_job("interval", hours=1, id="zhipu_trim_image_description")
+async def _trim_image_description() -> None:
+    """定时任务：裁剪持久化的图片描述缓存"""
+    max_size = int(ChatConfig.get("IMAGE_DESC_CACHE_SIZE") or 0)
+    if max_size > 0 and (count := await ZhipuImageDescription.trim(max_size)):
+        logger.debug(f"清理 {count} 条较久未使用的图片描述", "zhipu_toolkit")
+
+
+@driver.on_shutdown
+async def _close_image_fetcher() -> None:
+    await ImageFetcher.close()
+
+
+@scheduler.scheduled_job("cron", hour=4, minute=30, id="zhipu_prune_image_store")
+async def _prune_image_store() -> None:
+    """定时任务：清理对话记录均已过期的图片"""
+    day = ChatConfig.get("EXPIRE_DAY")
+    if day < 0:
+        return
+    # 多保留一天，避免与对话记录的过期清理产生时间差
+    if count := await ImageStore.prune(day + 1):
+        logger.info(f"清理 {count} 张过期的对话图片", "zhipu_toolkit")
@@ -0,0 +1,210 @@
+import asyncio
+from collections.abc import Callable
+import re
+import time
+from typing import Any, ClassVar, TypeVar
+
+from zhenxun.services.log import logger
+
+from .config import ChatConfig
+from .executor import WorkloadExecutor
+
+T = TypeVar("T")
+
+# 智谱限流相关错误码：并发过高 / 频率过高 / 调用次数超限 / 请求过多
+RATE_LIMIT_CODES = re.compile(r"\b130[2-5]\b")
+
+
+def is_rate_limited(e: Exception) -> bool:
+    """判断异常是否为服务端限流 (HTTP 429)"""
+    status = getattr(e, "status_code", None)
+    if status is None and (response := getattr(e, "response", None)) is not None:
+        status = getattr(response, "status_code", None)
+    return status == 429 or bool(RATE_LIMIT_CODES.search(str(e)))
+
+
+def get_retry_after(e: Exception) -> float | None:
+    """读取限流响应中的 Retry-After 头"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """按分钟配额匀速补充的令牌桶"""
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def refill(self, now: float, scale: float) -> None:
+        rate = self.capacity * scale / 60
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def delay_for(self, amount: float, scale: float) -> float:
+        """距离桶内令牌足够支付 amount 还需等待的秒数"""
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / (self.capacity * scale / 60)
+
+
+class ModelLimiter:
+    """单个模型的限流器
+
+    同时限制每分钟请求数与每分钟 token 数；收到限流响应后收缩速率并暂停放行，
+    之后随成功请求逐步恢复。等待中的调用按到达顺序排队。
+    """
+
+    MIN_SCALE = 0.1
+
+    def __init__(self, model: str, rpm: int, tpm: int) -> None:
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.scale = 1.0
+        self.blocked_until = 0.0
+        self.strikes = 0
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    def configure(self, rpm: int, tpm: int) -> None:
+        if self.requests.capacity != rpm:
+            self.requests = TokenBucket(rpm)
+        if self.tokens.capacity != tpm:
+            self.tokens = TokenBucket(tpm)
+
+    def _reserve(self, tokens: int) -> float:
+        """尝试预扣额度，成功返回 0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        buckets = [(self.requests, 1.0), (self.tokens, float(tokens))]
+        buckets = [(bucket, cost) for bucket, cost in buckets if bucket.enabled]
+        for bucket, _ in buckets:
+            bucket.refill(now, self.scale)
+        delay = max((b.delay_for(cost, self.scale) for b, cost in buckets), default=0)
+        if delay > 0:
+            return delay
+        for bucket, cost in buckets:
+            bucket.tokens -= min(cost, bucket.capacity)
+        return 0.0
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """等待直到额度足够，并预扣本次请求的额度"""
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while (delay := self._reserve(tokens)) > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+    def on_limited(self, retry_after: float | None = None) -> float:
+        """收到限流响应：速率减半并暂停放行，返回暂停时长"""
+        self.strikes += 1
+        self.scale = max(self.scale / 2, self.MIN_SCALE)
+        pause = retry_after or min(2**self.strikes, 60)
+        self.blocked_until = time.monotonic() + pause
+        self.requests.tokens = 0
+        return pause
+
+    def on_success(self) -> None:
+        """请求成功：逐步恢复速率"""
+        self.strikes = 0
+        self.scale = min(self.scale + 0.05, 1.0)
+
+    def stats(self) -> dict[str, Any]:
+        now = time.monotonic()
+        for bucket in (self.requests, self.tokens):
+            if bucket.enabled:
+                bucket.refill(now, self.scale)
+        return {
+            "rpm": self.requests.capacity,
+            "rpm_left": self.requests.tokens,
+            "tpm": self.tokens.capacity,
+            "tpm_left": self.tokens.tokens,
+            "scale": self.scale,
+            "waiting": self.waiting,
+            "blocked": max(self.blocked_until - now, 0.0),
+        }
+
+
+class RateLimiter:
+    limiters: ClassVar[dict[str, ModelLimiter]] = {}
+    MAX_ATTEMPTS = 4
+    """被限流时最多尝试的次数"""
+
+    @classmethod
+    def _limits(cls, model: str) -> tuple[int, int]:
+        overrides: dict = ChatConfig.get("RATE_LIMIT_MODELS") or {}
+        if limits := overrides.get(model):
+            return int(limits[0]), int(limits[1])
+        return (
+            int(ChatConfig.get("RATE_LIMIT_RPM") or 0),
+            int(ChatConfig.get("RATE_LIMIT_TPM") or 0),
+        )
+
+    @classmethod
+    def get(cls, model: str) -> ModelLimiter:
+        rpm, tpm = cls._limits(model)
+        if limiter := cls.limiters.get(model):
+            limiter.configure(rpm, tpm)
+            return limiter
+        limiter = cls.limiters[model] = ModelLimiter(model, rpm, tpm)
+        return limiter
+
+    @classmethod
+    async def run(
+        cls,
+        model: str,
+        executor: WorkloadExecutor,
+        func: Callable[[], T],
+        tokens: int = 0,
+    ) -> T:
+        """经过限流器后在指定线程池中执行一次 API 调用
+
+        被服务端限流时不会直接失败，而是退避后重新排队，直至用尽尝试次数。
+        """
+        limiter = cls.get(model)
+        for attempt in range(1, cls.MAX_ATTEMPTS + 1):
+            await limiter.acquire(tokens)
+            try:
+                result = await executor.run(func)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == cls.MAX_ATTEMPTS:
+                    raise
+                pause = limiter.on_limited(get_retry_after(e))
+                logger.warning(
+                    f"模型 {model} 触发限流，{pause:.1f}s 后重试 ({attempt})",
+                    "zhipu_toolkit",
+                )
+                continue
+            limiter.on_success()
+            return result
+        raise RuntimeError("unreachable")
+
+    @classmethod
+    def report(cls) -> list[str]:
+        lines = ["[限流器]"]
+        for model, limiter in cls.limiters.items():
+            s = limiter.stats()
+            rpm = f"{s['rpm_left']:.0f}/{s['rpm']:.0f}" if s["rpm"] else "不限"
+            tpm = f"{s['tpm_left']:.0f}/{s['tpm']:.0f}" if s["tpm"] else "不限"
+            lines.append(
+                f"{model}: 请求 {rpm}, token {tpm}, 速率 {s['scale']:.0%}, "
+                f"排队 {s['waiting']}"
+                + (f", 暂停 {s['blocked']:.0f}s" if s["blocked"] else "")
+            )
+        return lines
@@ -0,0 +1,85 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+import contextlib
+import time
+
+
+class WaitStats:
+    __slots__ = ("count", "max_wait", "total_wait")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float) -> None:
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class _Entry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class KeyedLock:
+    """按 key 串行化的锁表
+
+    同一 key 的持有者按到达顺序依次执行，不同 key 之间互不影响。锁只在有持有者或
+    等待者时存在，释放后立即回收，因此内存占用只与当前活跃的 key 数量相关；等待耗时
+    统计只保留最近活跃的 `max_stats` 个 key。
+    """
+
+    def __init__(self, max_stats: int = 256) -> None:
+        self._entries: dict[str, _Entry] = {}
+        self._stats: OrderedDict[str, WaitStats] = OrderedDict()
+        self._max_stats = max_stats
+
+    def _record(self, key: str, wait: float) -> None:
+        stats = self._stats.pop(key, None) or WaitStats()
+        stats.record(wait)
+        self._stats[key] = stats
+        while len(self._stats) > self._max_stats:
+            self._stats.popitem(last=False)
+
+    def locked(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.lock.locked()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+        entry.users += 1
+        start = time.monotonic()
+        try:
+            async with entry.lock:
+                self._record(key, time.monotonic() - start)
+                yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                self._entries.pop(key, None)
+
+    def report(self, top: int = 5) -> list[str]:
+        lines = [f"[会话锁] 活跃 {len(self._entries)}"]
+        hottest = sorted(
+            self._stats.items(), key=lambda item: item[1].total_wait, reverse=True
+        )[:top]
+        lines.extend(
+            f"{key}: {s.count} 轮, 等待 avg {s.total_wait / s.count * 1000:.0f}ms "
+            f"max {s.max_wait * 1000:.0f}ms"
+            for key, s in hottest
+            if s.count
+        )
+        return lines
+
+
+CONVERSATION_LOCK = KeyedLock()
+"""对话轮次按 uid 串行化"""
@@ -1,8 +1,10 @@
 from datetime import datetime, timedelta
+import hashlib
 from typing import ClassVar
 
 from pydantic import BaseModel
 from tortoise import fields
+from tortoise.expressions import Q
 from tortoise.functions import Count
 from tortoise.transactions import in_transaction
 from tortoise.validators import Validator
@@ -11,6 +13,10 @@ from zai.types.chat.chat_completion import CompletionMessage
 from zhenxun.services.db_context import Model
 
 
+def url_hash(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
 class ZhipuResult(BaseModel):
     content: str | None = None
     error_code: int
@@ -46,11 +52,13 @@ class ZhipuChatHistory(Model):
     """工具调用的记录"""
     create_time = fields.DatetimeField(auto_now_add=True)
     """创建时间"""
+    compacted = fields.BooleanField(default=False, description="是否已被压缩进摘要")
+    """是否已被压缩进摘要，已压缩的记录不再发送给模型"""
 
     class Meta:  # pyright: ignore [reportIncompatibleVariableOverride]
         table = "zhipu_chat_history"
         table_description = "智谱对话历史表"
-        indexes: ClassVar = [("uid",)]
+        indexes: ClassVar = [("uid", "id"), ("create_time",)]
 
     @classmethod
     async def clear_history(cls, uid: str | None = None) -> int:
@@ -60,12 +68,94 @@ class ZhipuChatHistory(Model):
             )
 
     @classmethod
-    async def get_history(cls, uid: str) -> list[dict]:
+    async def clear_histories(
+        cls, uids: list[str] | None = None, prefixes: list[str] | None = None
+    ) -> dict[str, int]:
+        """
+        在单个事务中清理多个uid或指定前缀（如 `g-`）的全部记录
+
+        :return: 各 uid 被删除的记录数
+        """
+        condition = Q(uid__in=uids) if uids else None
+        for prefix in prefixes or []:
+            q = Q(uid__startswith=prefix)
+            condition = q if condition is None else condition | q
+        if condition is None:
+            return {}
+        async with in_transaction():
+            rows = (
+                await cls.filter(condition)
+                .annotate(record_count=Count("id"))
+                .group_by("uid")
+                .values_list("uid", "record_count")
+            )
+            if rows:
+                await cls.filter(condition).delete()
+        return {uid: count for uid, count in rows}
+
+    @classmethod
+    async def bulk_append(cls, records: list[dict]) -> int:
         """
-        获取指定用户的所有对话记录
+        在单个事务中用一条批量 INSERT 写入多条对话记录
+
+        :param records: 记录列表，每条需包含 `uid` 与 `role`，
+            可选 `content`、`res_url`、`tool_calls`、`tool_call_id`；允许混合多个 uid
+        :return: 写入的记录数
+        """
+        if not records:
+            return 0
+        validate_role = RoleValidator()
+        instances = []
+        for rec in records:
+            validate_role(rec["role"])
+            instances.append(
+                cls(
+                    uid=rec["uid"],
+                    role=rec["role"],
+                    content=rec.get("content"),
+                    res_url=rec.get("res_url"),
+                    tool_calls=rec.get("tool_calls"),
+                    tool_call_id=rec.get("tool_call_id"),
+                )
+            )
+        async with in_transaction() as conn:
+            await cls.bulk_create(instances, using_db=conn)
+        return len(instances)
+
+    @staticmethod
+    def to_message(
+        role: str,
+        content: str | None,
+        res_url: str | None,
+        tool_calls: list | None,
+        tool_call_id: str | None,
+    ) -> dict:
+        return {
+            "role": role,
+            "content": (
+                [
+                    {"type": "text", "text": content},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": res_url},
+                    },
+                ]
+                if res_url
+                else content
+            ),
+            "tool_call_id": tool_call_id,
+            "tool_calls": tool_calls,
+        }
+
+    @classmethod
+    async def get_history(cls, uid: str, limit: int | None = None) -> list[dict]:
+        """
+        获取指定用户的对话记录
 
         :param uid: 用户唯一标识符
-        :return: 包含所有历史记录的字典列表，格式示例：
+        :param limit: 只读取最近的 limit 条记录，为 None 时读取全部；
+            窗口起点若落在工具调用之后，会丢弃失去对应调用的工具结果
+        :return: 按时间顺序排列的历史记录字典列表，格式示例：
         ```
             [
                 {
@@ -78,40 +168,112 @@ class ZhipuChatHistory(Model):
             ]
         ```
         """
-        records = await cls.filter(uid=uid).order_by("id").all()
-        data = []
-        data.extend(
-            {
-                "role": record.role,
-                "content": (
-                    [
-                        {"type": "text", "text": record.content},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": record.res_url},
-                        },
-                    ]
-                    if record.res_url
-                    else record.content
-                ),
-                "tool_call_id": record.tool_call_id,
-                "tool_calls": record.tool_calls,
-            }
-            for record in records
+        fields = ("role", "content", "res_url", "tool_calls", "tool_call_id")
+        if limit is None:
+            rows = await cls.filter(uid=uid).order_by("id").values_list(*fields)
+            return [cls.to_message(*row) for row in rows]
+
+        # 摘要记录（role 为 system）固定放在最前，其后是未压缩的最近窗口
+        query = cls.filter(uid=uid, compacted=False)
+        summary = (
+            await query.filter(role="system")
+            .order_by("-id")
+            .first()
+            .values_list(*fields)
         )
-        return data
+        rows = (
+            await query.exclude(role="system")
+            .order_by("-id")
+            .limit(limit)
+            .values_list(*fields)
+        )
+        rows.reverse()
+        start = 0
+        while start < len(rows) and rows[start][0] == "tool":
+            start += 1
+        rows = [summary, *rows[start:]] if summary else rows[start:]
+        return [cls.to_message(*row) for row in rows]
+
+    @classmethod
+    async def get_history_page(
+        cls, uid: str, before_id: int | None, size: int
+    ) -> list[tuple[int, dict]]:
+        """
+        读取id小于 before_id 的最近一页记录（keyset 分页）
 
+        :param before_id: 上一页最早一条记录的id，为 None 时从最新的记录开始
+        :return: (id, 记录字典) 列表，按id倒序排列
+        """
+        fields = ("role", "content", "res_url", "tool_calls", "tool_call_id")
+        query = cls.filter(uid=uid)
+        if before_id is not None:
+            query = query.filter(id__lt=before_id)
+        rows = await query.order_by("-id").limit(size).values_list("id", *fields)
+        return [(row[0], cls.to_message(*row[1:])) for row in rows]
 
     @classmethod
-    async def get_user_list(cls) -> list[tuple[str, int]]:
-        """获取所有用户的uid及其记录数量（元组列表形式）"""
-        results = (
-            await cls.all()
-            .annotate(record_count=Count("id"))
-            .group_by("uid")
-            .values("uid", "record_count")
+    async def get_compactable(
+        cls, uid: str, keep: int, max_rows: int = 400
+    ) -> list[tuple[int, str, str | None]]:
+        """
+        获取可压缩进摘要的最早记录
+
+        :param keep: 保留不压缩的最近记录数
+        :param max_rows: 单次最多压缩的记录数
+        :return: (id, role, content) 列表，包含此前的摘要；不会把工具调用与其结果拆开
+        """
+        query = cls.filter(uid=uid, compacted=False)
+        count = min(await query.count() - keep, max_rows)
+        if count <= 0:
+            return []
+        rows = (
+            await query.order_by("id")
+            .limit(count + 8)
+            .values_list("id", "role", "content")
+        )
+        cut = count
+        while cut < len(rows) and rows[cut][1] == "tool":
+            cut += 1
+        return rows[:cut]
+
+    @classmethod
+    async def compact(cls, uid: str, ids: list[int], summary: str) -> int:
+        """
+        将指定记录标记为已压缩，并写入覆盖它们的摘要记录
+
+        :return: 实际标记的记录数，为 0 时（记录已被清理）不写入摘要
+        """
+        async with in_transaction() as conn:
+            updated = (
+                await cls.filter(uid=uid, id__in=ids, compacted=False)
+                .using_db(conn)
+                .update(compacted=True)
+            )
+            if updated:
+                await cls.create(uid=uid, role="system", content=summary, using_db=conn)
+        return updated
+
+    @classmethod
+    async def get_user_stats(cls) -> list[tuple[str, int, datetime | None, int]]:
+        """
+        汇总每个uid的记录数、最后活跃时间与内容字节数（估算）
+
+        需要扫描全表，仅用于初始化内存中的统计
+        """
+        rows = await cls._meta.db.execute_query_dict(
+            "SELECT uid, COUNT(id) AS record_count, MAX(create_time) AS last_time,"
+            " SUM(COALESCE(LENGTH(content), 0) + COALESCE(LENGTH(res_url), 0))"
+            " AS size FROM zhipu_chat_history GROUP BY uid"
         )
-        return [(item["uid"], item["record_count"]) for item in results]
+        result = []
+        for row in rows:
+            last_time = row["last_time"]
+            if last_time is not None and not isinstance(last_time, datetime):
+                last_time = datetime.fromisoformat(str(last_time))
+            result.append(
+                (row["uid"], int(row["record_count"]), last_time, int(row["size"] or 0))
+            )
+        return result
 
     @classmethod
     async def delete_latest_record(cls, uid: str) -> int:
@@ -123,15 +285,122 @@ class ZhipuChatHistory(Model):
         return 0
 
     @classmethod
-    async def delete_old_records(cls, days: int) -> int:
-        """删除 n 天前的所有记录"""
+    async def delete_old_records(
+        cls, days: int, limit: int = 500
+    ) -> dict[str, int]:
+        """
+        删除最早的一批 n 天前的记录
+
+        :param limit: 单个事务最多删除的记录数，避免长时间锁表
+        :return: 各 uid 被删除的记录数，为空表示已没有过期记录
+        """
         cutoff = datetime.now() - timedelta(days=days)
+        rows = (
+            await cls.filter(create_time__lt=cutoff)
+            .order_by("create_time")
+            .limit(limit)
+            .values_list("id", "uid")
+        )
+        if not rows:
+            return {}
 
         async with in_transaction():
-            deleted = await cls.filter(create_time__lt=cutoff).delete()
+            await cls.filter(id__in=[row_id for row_id, _ in rows]).delete()
 
+        deleted: dict[str, int] = {}
+        for _, uid in rows:
+            deleted[uid] = deleted.get(uid, 0) + 1
         return deleted
 
     @classmethod
     async def _run_script(cls):
-        return ["ALTER TABLE zhipu_chat_history ADD COLUMN res_url TEXT DEFAULT NULL"]
+        return [
+            "ALTER TABLE zhipu_chat_history ADD COLUMN res_url TEXT DEFAULT NULL",
+            "ALTER TABLE zhipu_chat_history ADD COLUMN compacted BOOLEAN DEFAULT FALSE",
+            # 与 Meta.indexes 生成的索引同名，旧表补建、新表跳过
+            "CREATE INDEX IF NOT EXISTS idx_zhipu_chat__uid_22bea7"
+            " ON zhipu_chat_history (uid, id)",
+            # 旧版本 Meta.indexes 的 (uid) 单列索引已被 (uid, id) 覆盖
+            "DROP INDEX IF EXISTS idx_zhipu_chat__uid_9b980a",
+            "CREATE INDEX IF NOT EXISTS idx_zhipu_chat__create__2de5b8"
+            " ON zhipu_chat_history (create_time)",
+        ]
+
+
+class ZhipuImageDescription(Model):
+    digest = fields.CharField(64, pk=True, description="图片内容的sha256")
+    """图片内容的sha256"""
+    url = fields.TextField(
+        null=True, default=None, description="最近一次的图片链接"
+    )
+    """最近一次的图片链接"""
+    url_hash = fields.CharField(
+        64, null=True, default=None, description="最近一次的图片链接的sha256"
+    )
+    """最近一次的图片链接的sha256，用于按链接查询"""
+    description = fields.TextField(description="图片描述")
+    """图片理解模型生成的描述"""
+    last_used = fields.DatetimeField(auto_now=True, description="最近使用时间")
+    """最近使用时间"""
+
+    class Meta:  # pyright: ignore [reportIncompatibleVariableOverride]
+        table = "zhipu_image_description"
+        table_description = "智谱图片描述缓存表"
+        indexes: ClassVar = [("last_used",), ("url_hash",)]
+
+    @classmethod
+    async def lookup(cls, digest: str) -> str | None:
+        """读取描述并刷新最近使用时间"""
+        record = await cls.get_or_none(digest=digest)
+        if record is None:
+            return None
+        await cls.filter(digest=digest).update(last_used=datetime.now())
+        return record.description
+
+    @classmethod
+    async def lookup_url(cls, url: str) -> tuple[str, str] | None:
+        """按图片链接读取描述并刷新最近使用时间
+
+        :return: (图片内容的sha256, 描述)，未找到时返回 None
+        """
+        record = await cls.get_or_none(url_hash=url_hash(url), url=url)
+        if record is None:
+            return None
+        await cls.filter(digest=record.digest).update(last_used=datetime.now())
+        return record.digest, record.description
+
+    @classmethod
+    async def store(cls, digest: str, url: str, description: str) -> None:
+        await cls.update_or_create(
+            digest=digest,
+            defaults={
+                "url": url,
+                "url_hash": url_hash(url),
+                "description": description,
+            },
+        )
+
+    @classmethod
+    async def trim(cls, max_size: int) -> int:
+        """只保留最近使用的 max_size 条描述，每次至多删除 1000 条，返回删除的数量"""
+        stale = (
+            await cls.all()
+            .order_by("-last_used")
+            .offset(max_size)
+            .limit(1000)
+            .values_list("digest", flat=True)
+        )
+        if not stale:
+            return 0
+        async with in_transaction():
+            return await cls.filter(digest__in=stale).delete()
+
+    @classmethod
+    async def _run_script(cls):
+        return [
+            "ALTER TABLE zhipu_image_description"
+            " ADD COLUMN url_hash VARCHAR(64) DEFAULT NULL",
+            # 与 Meta.indexes 生成的索引同名，旧表补建、新表跳过
+            "CREATE INDEX IF NOT EXISTS idx_zhipu_image_url_has_de990c"
+            " ON zhipu_image_description (url_hash)",
+        ]
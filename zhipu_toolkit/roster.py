@@ -0,0 +1,119 @@
+import asyncio
+from collections import OrderedDict
+import re
+import time
+
+from nonebot import get_bot
+from nonebot.adapters import Event
+
+from zhenxun.services.log import logger
+from zhenxun.utils.platform import PlatformUtils
+
+from .config import ChatConfig
+
+# 最多缓存多少个群的成员列表
+MAX_GROUPS = 200
+# 加载失败后多久重试
+RETRY_SECONDS = 60
+
+
+def clean_name(name: str) -> str:
+    return re.sub(r"[\x00-\x09\x0b-\x1f\x7f-\x9f]", "", name)
+
+
+class _Roster:
+    __slots__ = ("loaded_at", "names")
+
+    def __init__(self, names: dict[str, str], loaded_at: float) -> None:
+        self.names = names
+        self.loaded_at = loaded_at
+
+
+class GroupRoster:
+    """群成员名片缓存
+
+    一次平台调用加载整个群的成员列表并按 uid 索引，超过 `ROSTER_TTL` 后在后台刷新；
+    入群、退群与名片变更通知会直接更新缓存。
+    """
+
+    def __init__(self) -> None:
+        self._rosters: OrderedDict[str, _Roster] = OrderedDict()
+        self._loading: dict[str, asyncio.Task[_Roster]] = {}
+
+    @property
+    def ttl(self) -> float:
+        return float(ChatConfig.get("ROSTER_TTL") or 0)
+
+    def peek(self, group_id: str, uid: str) -> str | None:
+        """只从缓存中读取名称，不触发加载"""
+        roster = self._rosters.get(group_id)
+        return roster.names.get(uid) if roster is not None else None
+
+    async def get(self, bot_id: str, group_id: str, uid: str) -> str | None:
+        roster = self._rosters.get(group_id)
+        if roster is None:
+            # 加载期间本群可能已被其他群挤出缓存，直接使用加载到的名单
+            roster = await self._load(bot_id, group_id)
+            return roster.names.get(uid)
+        if time.monotonic() - roster.loaded_at > self.ttl:
+            # 过期时先使用旧数据，在后台刷新
+            self._load(bot_id, group_id)
+        self._rosters.move_to_end(group_id)
+        return roster.names.get(uid)
+
+    def _load(self, bot_id: str, group_id: str) -> asyncio.Task[_Roster]:
+        if (task := self._loading.get(group_id)) is None:
+            task = self._loading[group_id] = asyncio.create_task(
+                self._fetch(bot_id, group_id)
+            )
+            task.add_done_callback(lambda _: self._loading.pop(group_id, None))
+        return task
+
+    async def _fetch(self, bot_id: str, group_id: str) -> _Roster:
+        try:
+            members = await PlatformUtils.get_group_member_list(
+                get_bot(bot_id), group_id
+            )
+            names = {
+                str(member.user_id): name
+                for member in members
+                if (name := clean_name(member.card or member.name or ""))
+            }
+            roster = _Roster(names, time.monotonic())
+        except Exception as e:
+            logger.warning(f"获取群 {group_id} 成员列表失败", "zhipu_toolkit", e=e)
+            previous = self._rosters.get(group_id)
+            roster = _Roster(
+                previous.names if previous is not None else {},
+                time.monotonic() - self.ttl + RETRY_SECONDS,
+            )
+        self._rosters[group_id] = roster
+        self._rosters.move_to_end(group_id)
+        while len(self._rosters) > MAX_GROUPS:
+            self._rosters.popitem(last=False)
+        return roster
+
+    def set_name(self, group_id: str, uid: str, name: str) -> None:
+        if (roster := self._rosters.get(group_id)) is not None and name:
+            roster.names[uid] = name
+
+    def remove(self, group_id: str, uid: str) -> None:
+        if (roster := self._rosters.get(group_id)) is not None:
+            roster.names.pop(uid, None)
+
+    def handle_notice(self, event: Event) -> None:
+        """根据入群、退群与名片变更通知更新缓存"""
+        group_id = getattr(event, "group_id", None)
+        user_id = getattr(event, "user_id", None)
+        if group_id is None or user_id is None:
+            return
+        group_id, user_id = str(group_id), str(user_id)
+        match getattr(event, "notice_type", None):
+            case "group_card" if card := getattr(event, "card_new", None):
+                self.set_name(group_id, user_id, clean_name(card))
+            case "group_increase" | "group_decrease" | "group_card":
+                # 新成员与清空名片的成员在下次使用时单独查询
+                self.remove(group_id, user_id)
+
+
+GROUP_ROSTER = GroupRoster()
@@ -0,0 +1,71 @@
+from collections import deque
+from typing import ClassVar
+
+from .breaker import Breakers
+from .config import ChatConfig
+
+# 出现这些词时大概率需要调用工具，交给主模型处理
+TOOL_HINTS = ("禁言", "解禁", "拉黑", "封禁", "点赞", "赞我", "说说", "语音")
+
+
+class ModelRouter:
+    """对话模型路由
+
+    简单的闲聊交给 `ROUTER_LIGHT_MODELS` 中当前最快的模型，长消息、带图片或引用、
+    可能需要调用工具的消息交给 `CHAT_MODEL`。
+    """
+
+    latencies: ClassVar[dict[str, deque[float]]] = {}
+
+    @classmethod
+    def record(cls, model: str, seconds: float) -> None:
+        """记录一次成功请求的耗时"""
+        if (window := cls.latencies.get(model)) is None:
+            window = cls.latencies[model] = deque(maxlen=100)
+        window.append(seconds)
+
+    @classmethod
+    def percentile(cls, model: str, q: float) -> float | None:
+        if not (window := cls.latencies.get(model)):
+            return None
+        ordered = sorted(window)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    @classmethod
+    def is_light(cls, message: str, has_image: bool, has_reply: bool) -> bool:
+        """判断本轮是否为无需主模型的简单对话"""
+        if has_image or has_reply:
+            return False
+        if len(message) > int(ChatConfig.get("ROUTER_LIGHT_MAX_LEN") or 0):
+            return False
+        return not any(hint in message for hint in TOOL_HINTS)
+
+    @classmethod
+    def route(cls, message: str, has_image: bool, has_reply: bool) -> str:
+        chat_model: str = ChatConfig.get("CHAT_MODEL")
+        light_models: list[str] = ChatConfig.get("ROUTER_LIGHT_MODELS") or []
+        if not light_models or not cls.is_light(message, has_image, has_reply):
+            return chat_model
+        candidates = [
+            model
+            for model in dict.fromkeys([*light_models, chat_model])
+            if Breakers.get(model).state != "open"
+        ]
+        if not candidates:
+            return chat_model
+        # 尚无样本的模型优先尝试，其余按 p95 延迟、再按 p50 延迟择优
+        return min(
+            candidates,
+            key=lambda m: (cls.percentile(m, 0.95) or 0, cls.percentile(m, 0.5) or 0),
+        )
+
+    @classmethod
+    def report(cls) -> list[str]:
+        lines = ["[模型延迟]"]
+        for model, window in cls.latencies.items():
+            p50 = cls.percentile(model, 0.5) or 0
+            p95 = cls.percentile(model, 0.95) or 0
+            lines.append(
+                f"{model}: p50 {p50:.2f}s, p95 {p95:.2f}s ({len(window)} 次)"
+            )
+        return lines
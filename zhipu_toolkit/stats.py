@@ -0,0 +1,103 @@
+import asyncio
+from collections.abc import Iterable
+from datetime import datetime
+from typing import ClassVar
+
+from zhenxun.services.log import logger
+
+from .model import ZhipuChatHistory
+
+
+def record_size(record: dict) -> int:
+    """估算一条记录在数据库中占用的内容字节数"""
+    return len(record.get("content") or "") + len(record.get("res_url") or "")
+
+
+def _naive(value: datetime | None) -> datetime | None:
+    """统一为本地时区的 naive datetime，便于与 datetime.now() 比较"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+class UidStats:
+    __slots__ = ("count", "last_active", "size")
+
+    def __init__(
+        self, count: int = 0, last_active: datetime | None = None, size: int = 0
+    ) -> None:
+        self.count = count
+        self.last_active = last_active
+        self.size = size
+
+
+class HistoryStats:
+    """按 uid 维护的对话记录统计
+
+    启动后首次使用时扫描一次全表初始化，之后由写入、过期清理、压缩与清空记录时增量
+    更新，查看会话列表不再需要 GROUP BY 全表。字节数为估算值，删除部分记录时按平均
+    大小扣减。
+    """
+
+    stats: ClassVar[dict[str, UidStats]] = {}
+    _loaded: ClassVar[bool] = False
+    _lock: ClassVar[asyncio.Lock | None] = None
+
+    @classmethod
+    async def load(cls) -> None:
+        if cls._loaded:
+            return
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+        async with cls._lock:
+            if cls._loaded:
+                return
+            rows = await ZhipuChatHistory.get_user_stats()
+            cls.stats = {
+                uid: UidStats(count, _naive(last_active), size)
+                for uid, count, last_active, size in rows
+            }
+            cls._loaded = True
+            logger.debug(f"已加载 {len(cls.stats)} 个会话的统计", "zhipu_toolkit")
+
+    @classmethod
+    def record_insert(cls, records: Iterable[dict]) -> None:
+        """记录已写入数据库的记录，每条需包含 `uid`"""
+        if not cls._loaded:
+            return
+        now = datetime.now()
+        for record in records:
+            if (stats := cls.stats.get(record["uid"])) is None:
+                stats = cls.stats[record["uid"]] = UidStats()
+            stats.count += 1
+            stats.size += record_size(record)
+            stats.last_active = now
+
+    @classmethod
+    def record_delete(cls, uid: str, count: int) -> None:
+        """记录 uid 被删除了 count 条记录"""
+        if not cls._loaded or (stats := cls.stats.get(uid)) is None:
+            return
+        if count >= stats.count:
+            del cls.stats[uid]
+            return
+        stats.size -= stats.size * count // stats.count
+        stats.count -= count
+
+    @classmethod
+    def remove(cls, uid: str | None = None) -> None:
+        """uid 的记录被清空，uid 为 None 时清空全部"""
+        if uid is None:
+            cls.stats.clear()
+        else:
+            cls.stats.pop(uid, None)
+
+    @classmethod
+    async def list(cls) -> list[tuple[str, UidStats]]:
+        """按最后活跃时间倒序列出所有会话"""
+        await cls.load()
+        return sorted(
+            cls.stats.items(),
+            key=lambda item: item[1].last_active or datetime.min,
+            reverse=True,
+        )
@@ -1,22 +1,58 @@
 import asyncio
-import base64
 import datetime
 import re
 import uuid
 
 from nonebot import get_bot, require
 
-from zhenxun.utils.http_utils import AsyncHttpx
+from zhenxun.services.log import logger
 
 require("nonebot_plugin_alconna")
 require("nonebot_plugin_uninfo")
 from nonebot_plugin_alconna import At, Image, Text, UniMessage
 from nonebot_plugin_uninfo import Session, Uninfo
-from zai import ZhipuAiClient as ZhipuAI
 
 from zhenxun.utils.platform import PlatformUtils
+from zhenxun.utils.rules import ensure_group
 
+from ..client import ZhipuClient
 from ..config import ChatConfig
+from ..executor import Executors
+from ..images import DescriptionCache, ImageFetcher
+from ..limiter import RateLimiter
+from ..roster import GROUP_ROSTER, clean_name
+
+
+IMAGE_TOKENS = 1000
+"""单张图片按此 token 数估算"""
+
+_CJK_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str | None) -> int:
+    """粗略估算文本 token 数：中日韩字符约 1 字 1 token，其余约 4 字符 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_message_tokens(message: dict) -> int:
+    """估算单条对话消息的 token 数（含图片与工具调用）"""
+    content = message.get("content")
+    if isinstance(content, list):
+        tokens = sum(
+            IMAGE_TOKENS
+            if part.get("type") == "image_url"
+            else estimate_tokens(part.get("text"))
+            for part in content
+        )
+    else:
+        tokens = estimate_tokens(content)
+    if tool_calls := message.get("tool_calls"):
+        tokens += estimate_tokens(str(tool_calls))
+    # 每条消息的角色等固定开销
+    return tokens + 4
 
 
 def get_request_id() -> str:
@@ -32,23 +68,64 @@ def get_request_id() -> str:
 async def msg2str(
     msg: UniMessage, is_multimodal: bool = False
 ) -> tuple[str, str | None]:
-    message = ""
+    """将消息转换为文本，图片替换为描述（多模态模式下返回图片引用）
+
+    多张图片的描述并发生成，同时进行的数量受 `IMAGE_DESC_CONCURRENCY` 限制；超过
+    `IMAGE_DESC_TIMEOUT` 仍未完成的描述以占位文本代替，不阻塞本轮对话。
+    """
+    parts: list[str | asyncio.Task[str]] = []
     res = None
+    concurrency = int(ChatConfig.get("IMAGE_DESC_CONCURRENCY") or 4)
+    limit = asyncio.Semaphore(max(concurrency, 1))
+
+    async def describe(url: str) -> str:
+        async with limit:
+            return f"\n![#image:{await generate_image_description(url)}]"
+
     for segment in msg:
         if isinstance(segment, At):
-            message += f"<AT user={segment.target}> "
+            parts.append(f"<AT user={segment.target}> ")
         elif isinstance(segment, Image):
             assert segment.url is not None
             img_url = segment.url.replace("https://", "http://")
-            if is_multimodal:
-                res = base64.b64encode(await AsyncHttpx.get_content(img_url)).decode()
+            if is_multimodal and ChatConfig.get("IMAGE_URL_PASSTHROUGH"):
+                # 由模型服务端直接读取图片链接
+                res = img_url
+            elif is_multimodal:
+                try:
+                    res = await ImageFetcher.fetch(img_url)
+                except Exception as e:
+                    logger.warning(
+                        f"下载图片失败，改用图片描述: {img_url}", "zhipu_toolkit", e=e
+                    )
+                    parts.append(asyncio.create_task(describe(img_url)))
             else:
-                message += f"\n![#image:{await generate_image_description(img_url)}]"
+                parts.append(asyncio.create_task(describe(img_url)))
         elif isinstance(segment, Text):
-            message += segment.text
+            parts.append(segment.text)
         else:
-            message += str(segment).replace("[reply]", "\n")
-    return message, res
+            parts.append(str(segment).replace("[reply]", "\n"))
+
+    pending: set[asyncio.Task[str]] = set()
+    if tasks := [part for part in parts if isinstance(part, asyncio.Task)]:
+        timeout = float(ChatConfig.get("IMAGE_DESC_TIMEOUT") or 0) or None
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            # 描述在缓存中的生成不受影响，下次遇到同一张图片时即可直接使用
+            task.cancel()
+        if pending:
+            logger.debug(
+                f"{len(pending)} 张图片描述超时，使用占位文本", "zhipu_toolkit"
+            )
+
+    def text_of(part: str | asyncio.Task[str]) -> str:
+        if isinstance(part, str):
+            return part
+        if part in pending or part.exception() is not None:
+            return "\n![#image:图片描述超时]"
+        return part.result()
+
+    return "".join(text_of(part) for part in parts), res
 
 
 # def str2msg(message: str) -> list[Text]:
@@ -86,19 +163,27 @@ def get_username_by_session(session: Session) -> str:
         name = session.member.nick
     else:
         name = session.user.name
+    if name is None and ensure_group(session):
+        name = GROUP_ROSTER.peek(session.scene.id, session.user.id)
     if name is None:
         return "未知用户"
     return re.sub(r"[\x00-\x09\x0b-\x1f\x7f-\x9f]", "", name) or "未知用户"
 
 
-async def generate_image_description(url: str):
-    loop = asyncio.get_event_loop()
-    client = ZhipuAI(api_key=ChatConfig.get("API_KEY"))
+async def generate_image_description(url: str) -> str:
+    """获取图片描述，同一张图片只调用一次图像理解模型"""
+    return await DescriptionCache.get(url, _describe_image)
+
+
+async def _describe_image(url: str) -> str:
+    client = ZhipuClient.get()
+    model = ChatConfig.get("IMAGE_UNDERSTANDING_MODEL")
     try:
-        response = await loop.run_in_executor(
-            None,
+        response = await RateLimiter.run(
+            model,
+            Executors.vision,
             lambda: client.chat.completions.create(
-                model=ChatConfig.get("IMAGE_UNDERSTANDING_MODEL"),
+                model=model,
                 messages=[
                     {
                         "role": "user",
@@ -113,6 +198,7 @@ async def generate_image_description(url: str):
                 ],
                 user_id=str(uuid.uuid4()),
             ),
+            tokens=IMAGE_TOKENS,
         )
         result = response.choices[0].message.content  # type: ignore
     except Exception:
@@ -144,11 +230,70 @@ async def split_text(text: str) -> list[tuple[Text, float]]:
         while next_char_index < len(text) and text[next_char_index] == "？":
             r += "？"
             next_char_index += 1
-        results.append((Text(r), min(len(r) * 0.2, 3.0)))
+        results.append((Text(r), segment_delay(r)))
 
     return results
 
 
+def segment_delay(text: str) -> float:
+    """分段发送时每段之后的停顿时长"""
+    return min(len(text) * 0.2, 3.0)
+
+
+class StreamSegmenter:
+    """流式文本切割器
+
+    与 `split_text` 使用相同的分割规则：在 `[。？！\\n]` 处断句，保留紧随其后的问号，
+    并遵循 `TEXT_MAX_SPLIT` 的段数限制；首段会经过 `extract_message_content` 处理。
+    """
+
+    _PATTERN = re.compile(r"[。？！\n]+")
+
+    def __init__(self, max_split: int | None = None) -> None:
+        self.max_split: int = (
+            ChatConfig.get("TEXT_MAX_SPLIT") if max_split is None else max_split
+        )
+        self._buffer = ""
+        self._count = 0
+
+    def _can_split(self) -> bool:
+        return self.max_split == 0 or 0 <= self._count < self.max_split
+
+    def _emit(self, segment: str) -> list[str]:
+        if self._count == 0:
+            segment = extract_message_content(segment)
+        if not segment.strip():
+            return []
+        self._count += 1
+        return [segment]
+
+    def _drain(self, final: bool) -> list[str]:
+        segments: list[str] = []
+        while self._can_split():
+            match = self._PATTERN.search(self._buffer)
+            # 分隔符位于末尾时，后续片段可能仍是分隔符（如连续问号），需等待
+            if match is None or (not final and match.end() == len(self._buffer)):
+                break
+            question_marks = re.match(r"？*", match.group())
+            assert question_marks is not None
+            segment = self._buffer[: match.start()] + question_marks.group()
+            self._buffer = self._buffer[match.end() :]
+            segments.extend(self._emit(segment))
+        return segments
+
+    def feed(self, text: str) -> list[str]:
+        """追加增量文本，返回已完整的分段"""
+        self._buffer += text
+        return self._drain(final=False)
+
+    def flush(self) -> list[str]:
+        """一次回复结束时调用，返回剩余的全部分段"""
+        segments = self._drain(final=True)
+        rest, self._buffer = self._buffer.rstrip("。"), ""
+        segments.extend(self._emit(rest))
+        return segments
+
+
 def format_usr_msg(username: str, session: Uninfo, msg: str) -> str:
     """\n"""
     return (
@@ -191,9 +336,15 @@ def extract_message_content(msg: str | None) -> str:
 
 
 async def get_username(bot_id: str, uid: str, group_id: str | None = None) -> str:
+    if group_id is not None and (
+        name := await GROUP_ROSTER.get(bot_id, group_id, uid)
+    ):
+        return name
     bot = get_bot(bot_id)
     info = await PlatformUtils.get_user(bot, uid, group_id)
     if info is None:
         return "未知用户"
-    name = info.card or info.name
-    return re.sub(r"[\x00-\x09\x0b-\x1f\x7f-\x9f]", "", name)
+    name = clean_name(info.card or info.name)
+    if group_id is not None:
+        GROUP_ROSTER.set_name(group_id, uid, name)
+    return name
@@ -0,0 +1,188 @@
+import asyncio
+from collections.abc import Callable
+import contextlib
+import time
+from typing import Any
+
+import nonebot
+
+from zhenxun.services.log import logger
+
+from .config import ChatConfig
+from .model import ZhipuChatHistory
+from .stats import HistoryStats
+
+driver = nonebot.get_driver()
+
+# 队列已满时新的对话最多等待写入多久
+PUT_TIMEOUT = 10
+
+
+class HistoryWriteError(Exception):
+    """对话记录无法写入数据库"""
+
+
+class HistoryWriter:
+    """对话记录的异步写回队列
+
+    对话轮次只需把记录放入队列即可返回，后台任务定期把多个 uid 的记录合并为一次批量
+    INSERT。队列满时 `put` 会等待写入腾出空间，超过 `PUT_TIMEOUT` 仍无法写入时抛出
+    HistoryWriteError；需要读取最新数据库状态的地方应先调用 `flush`。
+    """
+
+    def __init__(self) -> None:
+        self._buffer: list[tuple[float, dict]] = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def interval(self) -> float:
+        return float(ChatConfig.get("HISTORY_FLUSH_INTERVAL") or 0)
+
+    @property
+    def max_size(self) -> int:
+        return max(int(ChatConfig.get("HISTORY_QUEUE_SIZE") or 1000), 1)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    async def put(self, uid: str, records: list[dict]) -> None:
+        """将一轮对话的记录加入写回队列
+
+        :raises HistoryWriteError: 数据库持续无法写入
+        """
+        if not records:
+            return
+        if self.interval <= 0:
+            # 未启用写回时直接同步写入
+            self._buffer.extend((time.monotonic(), {**r, "uid": uid}) for r in records)
+            await self.flush()
+            if self._buffer:
+                raise HistoryWriteError("对话记录写入数据库失败")
+            return
+        self.start()
+        # 背压：队列已满时等待后台写入腾出空间，数据库不可用时不能无限等待
+        deadline = time.monotonic() + PUT_TIMEOUT
+        while self._buffer and len(self._buffer) + len(records) > self.max_size:
+            self._wakeup.set()
+            self._drained.clear()
+            try:
+                await asyncio.wait_for(
+                    self._drained.wait(), deadline - time.monotonic()
+                )
+            except asyncio.TimeoutError:
+                raise HistoryWriteError(
+                    f"写回队列已满且 {PUT_TIMEOUT}s 内未能写入数据库"
+                ) from None
+        now = time.monotonic()
+        self._buffer.extend((now, {**r, "uid": uid}) for r in records)
+        if len(self._buffer) >= self.max_size // 2:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        """立即写入队列中的全部记录，返回时此前入队的记录均已落库"""
+        async with self._lock:
+            while self._buffer:
+                if not await self._write_batch():
+                    break
+
+    async def discard(
+        self, uid: str | Callable[[str], bool] | None = None
+    ) -> dict[str, int]:
+        """丢弃尚未写入的记录，返回各 uid 丢弃的条数
+
+        :param uid: 要丢弃的 uid，或判断 uid 是否丢弃的函数；为 None 时丢弃全部
+        """
+        if isinstance(uid, str):
+            target = uid
+            uid = lambda u: u == target  # noqa: E731
+        async with self._lock:
+            discarded: dict[str, int] = {}
+            kept: list[tuple[float, dict]] = []
+            for item in self._buffer:
+                record_uid = item[1]["uid"]
+                if uid is None or uid(record_uid):
+                    discarded[record_uid] = discarded.get(record_uid, 0) + 1
+                else:
+                    kept.append(item)
+            self._buffer = kept
+            self._drained.set()
+            return discarded
+
+    async def _write_batch(self) -> bool:
+        batch = self._buffer[: self.max_size]
+        started = time.monotonic()
+        try:
+            await ZhipuChatHistory.bulk_append([record for _, record in batch])
+        except Exception as e:
+            self.failures += 1
+            logger.error(
+                f"写入 {len(batch)} 条对话记录失败，稍后重试", "zhipu_toolkit", e=e
+            )
+            return False
+        del self._buffer[: len(batch)]
+        HistoryStats.record_insert(record for _, record in batch)
+        self.written += len(batch)
+        self.batches += 1
+        self.last_lag = time.monotonic() - batch[0][0]
+        self.max_lag = max(self.max_lag, self.last_lag)
+        self._drained.set()
+        logger.debug(
+            f"批量写入 {len(batch)} 条对话记录耗时 "
+            f"{(time.monotonic() - started) * 1000:.1f}ms",
+            "zhipu_toolkit",
+        )
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.interval or 1)
+            self._wakeup.clear()
+            if self._buffer:
+                async with self._lock:
+                    await self._write_batch()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "queued": len(self._buffer),
+            "oldest": time.monotonic() - self._buffer[0][0] if self._buffer else 0.0,
+            "written": self.written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+    def report(self) -> list[str]:
+        s = self.stats()
+        return [
+            "[写回队列]",
+            f"排队 {s['queued']} 条(最早 {s['oldest']:.1f}s), "
+            f"已写入 {s['written']} 条/{s['batches']} 批, 失败 {s['failures']} 次, "
+            f"写入延迟 {s['last_lag']:.2f}s (max {s['max_lag']:.2f}s)",
+        ]
+
+
+HISTORY_WRITER = HistoryWriter()
+
+
+@driver.on_shutdown
+async def _flush_history_writer() -> None:
+    await HISTORY_WRITER.stop()